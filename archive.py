@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""
+Move articles between blogs as Markdown files with a front matter:
+
+    ---
+    title: Hello world
+    slug: hello-world
+    tags: python flask
+    category: Programming
+    date: 2015-04-05 12:00:00
+    draft: false
+    ---
+    The article, in markdown...
+
+    python archive.py import posts/            # a directory of .md files
+    python archive.py import posts.tar.gz      # or a tarball, read as a stream
+    python archive.py export posts.tar.gz      # a tarball, or a directory
+
+Files are parsed, slugged and rendered by a pool of processes while the
+main process inserts them in batches, one transaction per batch.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import io
+import multiprocessing
+import os
+import re
+import tarfile
+
+from blog.models import (db, Article, Tag, ArticleTagThrough, Category, User, ArticleIndex,
+                         RenderedMarkdown, make_slug, markdown_key, markdown_to_html,
+                         abstract_markdown, search_enabled)
+from blog.cache import content_changed
+from peewee import fn, JOIN
+
+MARKDOWN_EXTENSIONS = ('.md', '.markdown')
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+# keeps every statement well below sqlite's limit of 999 variables
+MAX_ROWS = 100
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Reading
+
+def read_directory(path):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(MARKDOWN_EXTENSIONS):
+                with open(os.path.join(root, name), 'rb') as f:
+                    yield name, f.read()
+
+
+def read_tarball(path):
+    # 'r|*' reads the archive as a stream, whatever its compression
+    with tarfile.open(path, 'r|*') as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(MARKDOWN_EXTENSIONS):
+                yield os.path.basename(member.name), tar.extractfile(member).read()
+
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('unknown date format: %s' % value)
+
+
+def parse(item):
+    """
+    Turn a markdown file into an article row, and render its html and
+    abstract. Runs in the worker processes.
+    """
+    name, data = item
+    text = data.decode('utf-8').replace('\r\n', '\n')
+
+    meta = {}
+    match = re.match(r'---\n(.*?)\n---\n?', text, re.S)
+    if match:
+        for line in match.group(1).splitlines():
+            key, _, value = line.partition(':')
+            meta[key.strip().lower()] = value.strip()
+        text = text[match.end():]
+
+    title = meta.get('title') or os.path.splitext(name)[0]
+    tags = re.split(r'[\s,]+', meta.get('tags', '').strip('[]'))
+    date = meta.get('date')
+
+    rendered = [(markdown_key(text), markdown_to_html(text))]
+    abstract = abstract_markdown(text)
+    if abstract is not None:
+        rendered.append((markdown_key(abstract), markdown_to_html(abstract)))
+
+    row = {
+        'title': title,
+        'slug': make_slug(meta.get('slug'), title),
+        'content': text,
+        'is_published': meta.get('draft', '').lower() not in ('true', 'yes', '1'),
+        'post_date': parse_date(date) if date else datetime.datetime.now(),
+    }
+    return row, [tag for tag in tags if tag], meta.get('category'), rendered
+
+
+# Writing
+
+class Importer(object):
+
+    def __init__(self, author, default_category):
+        self.author = author
+        self.default_category = default_category
+        self.categories = dict((category.name, category.id) for category in Category.select())
+        self.count = 0
+
+    def category_id(self, name):
+        name = name or self.default_category
+        if name not in self.categories:
+            self.categories[name] = Category.create(name=name).id
+        return self.categories[name]
+
+    def insert(self, batch):
+        "Insert a batch of parsed files in a single transaction"
+        with db.atomic():
+            rows = []
+            for row, tags, category, rendered in batch:
+                row['author'] = self.author
+                row['category'] = self.category_id(category)
+                rows.append(row)
+            Article.insert_batch(rows)
+            ids = {}
+            for chunk in chunks([row['slug'] for row in rows], MAX_ROWS):
+                ids.update(Article
+                           .select(Article.slug, Article.id)
+                           .where(Article.slug << chunk)
+                           .tuples())
+
+            tags = {}
+            for names in chunks(sorted(set(name for _, names, _, _ in batch for name in names)), MAX_ROWS):
+                for tag in Tag.resolve(names):
+                    tags[tag.name.lower()] = tag
+
+            links = set()
+            for row, (_, names, _, _) in zip(rows, batch):
+                for name in names:
+                    links.add((ids[row['slug']], tags[name.lower()].id))
+            for chunk in chunks(sorted(links), MAX_ROWS):
+                ArticleTagThrough.insert_many(
+                    [{'article': article_id, 'tag': tag_id} for article_id, tag_id in chunk]).execute()
+
+            rendered = dict(pair for _, _, _, pairs in batch for pair in pairs)
+            for chunk in chunks(sorted(rendered.items()), MAX_ROWS):
+                (RenderedMarkdown
+                 .insert_many([{'key': key, 'html': html} for key, html in chunk])
+                 .upsert()
+                 .execute())
+
+            if search_enabled():
+                for chunk in chunks(list(zip(rows, batch)), MAX_ROWS // 4):
+                    ArticleIndex.insert_many([
+                        {'rowid': ids[row['slug']], 'title': row['title'], 'content': row['content'],
+                         'tags': ' '.join(names)}
+                        for row, (_, names, _, _) in chunk]).execute()
+
+        self.count += len(rows)
+
+
+def import_articles(source, author=None, category='Default', batch_size=MAX_ROWS, jobs=None):
+    if author:
+        author = User.get(User.username == author)
+    else:
+        author = User.select().order_by(User.id).get()
+    importer = Importer(author.id, category)
+
+    files = read_tarball(source) if os.path.isfile(source) else read_directory(source)
+    db.close()  # don't share the connection with the workers
+    pool = multiprocessing.Pool(jobs)
+    try:
+        batch = []
+        for parsed in pool.imap(parse, files, chunksize=16):
+            batch.append(parsed)
+            if len(batch) >= batch_size:
+                importer.insert(batch)
+                batch = []
+        if batch:
+            importer.insert(batch)
+    finally:
+        pool.close()
+        pool.join()
+
+    content_changed('article')
+    return importer.count
+
+
+def front_matter(article):
+    lines = ['---',
+             'title: %s' % article.title,
+             'slug: %s' % article.slug,
+             'tags: %s' % ' '.join(sorted((article.tag_names or '').split())),
+             'category: %s' % (article.category_name or ''),
+             'date: %s' % article.post_date.strftime(DATE_FORMATS[0]),
+             'draft: %s' % ('false' if article.is_published else 'true'),
+             '---',
+             '']
+    return '\n'.join(lines) + article.content
+
+
+def export_articles(target):
+    "Write every article to a tarball, or a directory, without loading them all"
+    query = (Article
+             .select(Article.title, Article.slug, Article.content, Article.post_date,
+                     Article.is_published, Category.name.alias('category_name'),
+                     fn.GROUP_CONCAT(Tag.name, ' ').alias('tag_names'))
+             .join(Category, JOIN.LEFT_OUTER)
+             .switch(Article)
+             .join(ArticleTagThrough, JOIN.LEFT_OUTER)
+             .join(Tag, JOIN.LEFT_OUTER)
+             .group_by(Article.id)
+             .order_by(Article.id)
+             .naive())
+
+    count = 0
+    if target.endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2')):
+        mode = 'w|' + {'gz': 'gz', 'tgz': 'gz', 'bz2': 'bz2'}.get(target.rsplit('.', 1)[-1], '')
+        with tarfile.open(target, mode) as tar:
+            for article in query.iterator():
+                data = front_matter(article).encode('utf-8')
+                info = tarfile.TarInfo('%s.md' % article.slug)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+                count += 1
+    else:
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for article in query.iterator():
+            with open(os.path.join(target, '%s.md' % article.slug), 'wb') as f:
+                f.write(front_matter(article).encode('utf-8'))
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import or export articles as markdown files.')
+    commands = parser.add_subparsers(dest='command')
+
+    importing = commands.add_parser('import', help='import a directory or tarball of markdown files')
+    importing.add_argument('source')
+    importing.add_argument('--author', help='username to file the articles under (default: the first user)')
+    importing.add_argument('--category', default='Default',
+                           help='category of articles that have none (default: Default)')
+    importing.add_argument('--batch-size', type=int, default=MAX_ROWS,
+                           help='articles per transaction (default: %d)' % MAX_ROWS)
+    importing.add_argument('--jobs', type=int, default=None,
+                           help='number of parsing processes (default: one per CPU)')
+
+    exporting = commands.add_parser('export', help='export all articles to a directory or tarball')
+    exporting.add_argument('target')
+
+    args = parser.parse_args()
+    if args.command == 'import':
+        count = import_articles(args.source, author=args.author, category=args.category,
+                                batch_size=args.batch_size, jobs=args.jobs)
+        print('%d articles imported' % count)
+    else:
+        print('%d articles exported' % export_articles(args.target))
+
+
+if __name__ == '__main__':
+    main()
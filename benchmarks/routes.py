@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+Benchmark the core routes against a generated blog:
+
+    python benchmarks/routes.py --articles 2000 --tags 200 --comments 20000 \
+        --output results/$(git rev-parse --short HEAD).json
+    python benchmarks/routes.py --compare results/old.json results/new.json
+
+A temporary database is seeded with the requested corpus, then every route
+is requested through Flask's test client, recording the latency and the
+number of SQL queries of each request. Results are written as JSON so runs
+on different commits can be compared.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ('flask peewee sqlite python blog article markdown template query cache index '
+         'request response server client page render worker thread process memory '
+         'latency throughput benchmark performance database table column').split()
+
+
+def configure(directory, page_cache):
+    "Point the application at a fresh database before it is imported"
+    settings = os.path.join(directory, 'settings.cfg')
+    with open(settings, 'w') as f:
+        f.write('DEBUG = False\n')
+        f.write('TESTING = True\n')
+        f.write('DATABASE = %r\n' % os.path.join(directory, 'blog.db'))
+        f.write('SETTINGS_STAMP = %r\n' % os.path.join(directory, 'blog.db.settings'))
+        f.write('PAGE_CACHE_STAMP = %r\n' % os.path.join(directory, 'blog.db.pages'))
+        f.write('PAGE_CACHE = %r\n' % ('memory' if page_cache else None))
+    os.environ['BLOG_SETTINGS'] = settings
+    sys.path.insert(0, ROOT)
+
+
+def sentence(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for i in range(words)).capitalize() + '.'
+
+
+def markdown_document(rng, paragraphs):
+    "Something like a real post: paragraphs, a list, a code block, a table"
+    parts = ['## ' + sentence(rng, 4)]
+    for i in range(paragraphs):
+        parts.append(' '.join(sentence(rng, rng.randint(8, 20)) for j in range(rng.randint(3, 6))))
+        if i == 0 and rng.random() < 0.5:
+            parts.append('<!-- more -->')
+        if i % 3 == 1:
+            parts.append('\n'.join('* ' + sentence(rng, 6) for j in range(4)))
+        if i % 4 == 2:
+            parts.append('```\n' + '\n'.join('def f%d(x):\n    return x * %d' % (j, j)
+                                              for j in range(5)) + '\n```')
+        if i % 5 == 3:
+            parts.append('| a | b |\n|---|---|\n' + '\n'.join('| %d | %d |' % (j, j * j)
+                                                               for j in range(5)))
+    return '\n\n'.join(parts)
+
+
+def seed(args):
+    from blog.models import (db, User, Category, Tag, Article, ArticleTagThrough, Comment,
+                             Profile, ArticleIndex, search_enabled)
+    from blog.helper import load_settings
+
+    rng = random.Random(args.seed)
+    user = User.create(username='bench', password='bench', email='bench@example.com',
+                       nickname='bench')
+    Profile.create(blog_title='Benchmark', blog_description='benchmark', blog_nickname='bench',
+                   about_me=markdown_document(rng, 3), per_page=args.per_page)
+    category = Category.create(name='Default')
+
+    def insert(model, rows):
+        for i in range(0, len(rows), 100):
+            model.insert_many(rows[i:i + 100]).execute()
+
+    with db.atomic():
+        insert(Tag, [{'name': 'tag%d' % i} for i in range(args.tags)])
+        start = datetime.datetime(2010, 1, 1)
+        insert(Article, [{
+            'title': sentence(rng, 5), 'slug': 'article-%d' % i, 'author': user.id,
+            'category': category.id, 'content': markdown_document(rng, args.paragraphs),
+            'is_published': rng.random() > 0.1,
+            'post_date': start + datetime.timedelta(hours=i)} for i in range(args.articles)])
+
+        article_ids = [id for id, in Article.select(Article.id).tuples()]
+        tag_ids = [id for id, in Tag.select(Tag.id).tuples()]
+        links = set()
+        for article_id in article_ids:
+            for tag_id in rng.sample(tag_ids, min(len(tag_ids), rng.randint(1, 5))):
+                links.add((article_id, tag_id))
+        insert(ArticleTagThrough, [{'article': a, 'tag': t} for a, t in sorted(links)])
+
+        comments = []
+        for i in range(args.comments):
+            comments.append({'nickname': 'reader%d' % i, 'email': 'reader@example.com',
+                             'content': sentence(rng, 15), 'article': rng.choice(article_ids),
+                             'post_date': start + datetime.timedelta(minutes=i)})
+        insert(Comment, comments)
+
+    if search_enabled():
+        ArticleIndex.rebuild()
+    load_settings()
+    return user
+
+
+class QueryCounter(object):
+    "Counts the statements the database executes"
+
+    def __init__(self, db):
+        self.count = 0
+        execute_sql = db.execute_sql
+
+        def counting_execute_sql(*args, **kwargs):
+            self.count += 1
+            return execute_sql(*args, **kwargs)
+        db.execute_sql = counting_execute_sql
+
+
+def login(client):
+    with client.session_transaction() as session:
+        session['_csrf_token'] = 'bench'
+    response = client.post('/login', data={'username': 'bench', 'password': 'bench',
+                                           '_csrf_token': 'bench'})
+    # a failed login renders the form again with a 200
+    location = response.headers.get('Location', '')
+    if response.status_code != 302 or '/login' in location:
+        raise RuntimeError('login failed: HTTP %d %s' % (response.status_code, location))
+
+
+def check_page(response):
+    "Why the response isn't the page asked for, None if it is"
+    if not 200 <= response.status_code < 300:
+        return 'HTTP %d %s' % (response.status_code, response.headers.get('Location', ''))
+    return None
+
+
+def check_created(response):
+    # a saved article redirects to its page, anything else is the form again
+    location = response.headers.get('Location', '')
+    if response.status_code != 302 or '/blog/' not in location:
+        return 'HTTP %d %s' % (response.status_code, location)
+    return None
+
+
+def measure(name, request, check, iterations, warmup, counter):
+    for i in range(warmup):
+        error = check(request(i))
+        if error:
+            raise RuntimeError('%s: %s' % (name, error))
+    latencies, queries = [], []
+    for i in range(iterations):
+        before = counter.count
+        started = time.time()
+        response = request(warmup + i)
+        latencies.append((time.time() - started) * 1000)
+        queries.append(counter.count - before)
+        error = check(response)
+        if error:
+            raise RuntimeError('%s: %s' % (name, error))
+
+    latencies.sort()
+
+    def pct(p):
+        return round(latencies[min(int(len(latencies) * p / 100.0), len(latencies) - 1)], 3)
+
+    return {'p50_ms': pct(50), 'p90_ms': pct(90), 'p99_ms': pct(99),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            'queries_per_request': round(sum(queries) / float(len(queries)), 2)}
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix='blog-bench-')
+    try:
+        configure(directory, args.page_cache)
+        from blog import app
+        from blog.models import db, Article, Tag
+        seed(args)
+
+        counter = QueryCounter(db)
+        rng = random.Random(args.seed)
+        slugs = [slug for slug, in Article.public().select(Article.slug).tuples()]
+        tags = [name for name, in Tag.select(Tag.name).tuples()]
+
+        anonymous = app.test_client()
+        author = app.test_client()
+        login(author)
+
+        def create(i):
+            with author.session_transaction() as session:
+                session['_csrf_token'] = 'bench'
+            return author.post('/create/', data={
+                'title': 'New article %d' % i, 'slug': '', 'category': '1',
+                'content': markdown_document(rng, args.paragraphs),
+                'tags': ' '.join(rng.sample(tags, min(len(tags), 3))),
+                'is_published': 'y', '_csrf_token': 'bench'})
+
+        routes = [
+            ('index', lambda i: anonymous.get('/'), check_page),
+            ('detail', lambda i: anonymous.get('/blog/%s/' % rng.choice(slugs)), check_page),
+            ('lists_tag', lambda i: anonymous.get('/lists/?tag=%s' % rng.choice(tags)), check_page),
+            ('tags', lambda i: anonymous.get('/tags/'), check_page),
+            ('admin', lambda i: author.get('/admin/'), check_page),
+            ('create_post', create, check_created),
+        ]
+
+        results = {}
+        for name, request, check in routes:
+            if args.routes and name not in args.routes:
+                continue
+            results[name] = measure(name, request, check, args.iterations, args.warmup, counter)
+            print('%-12s p50 %8.2f ms  p90 %8.2f ms  p99 %8.2f ms  %6.1f queries' % (
+                name, results[name]['p50_ms'], results[name]['p90_ms'], results[name]['p99_ms'],
+                results[name]['queries_per_request']))
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print('%-12s %22s %22s' % ('route', 'p50 ms (old -> new)', 'queries (old -> new)'))
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        a, b = old['results'][name], new['results'][name]
+        print('%-12s %9.2f -> %-9.2f %9.1f -> %-9.1f' % (
+            name, a['p50_ms'], b['p50_ms'], a['queries_per_request'], b['queries_per_request']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the core routes of the blog.')
+    parser.add_argument('--articles', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=100)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--paragraphs', type=int, default=8,
+                        help='paragraphs of markdown per article')
+    parser.add_argument('--per-page', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--page-cache', action='store_true',
+                        help='serve anonymous pages from the memory page cache')
+    parser.add_argument('--routes', nargs='*', help='only benchmark these routes')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of benchmarking')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run(args)
+    if args.output:
+        corpus = dict((key, getattr(args, key)) for key in
+                      ('articles', 'tags', 'comments', 'paragraphs', 'per_page', 'seed',
+                       'iterations', 'page_cache'))
+        with open(args.output, 'w') as f:
+            json.dump({'commit': git_commit(), 'date': datetime.datetime.now().isoformat(),
+                       'python': sys.version.split()[0], 'corpus': corpus,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""
+Compare the development server (run.py) with the production one (serve.py)
+under the same load, against the blog.db of the working directory:
+
+    python benchmarks/servers.py --clients 20 --slow-clients 5 --duration 20
+
+Every client requests the given paths over and over; slow clients keep a
+connection busy by sending their request headers one byte per second, the
+way a reader on a bad connection does.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from urllib2 import urlopen, HTTPError  # python 2
+except ImportError:
+    from urllib.request import urlopen  # python 3
+    from urllib.error import HTTPError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    'run.py': ([sys.executable, 'run.py'], ('127.0.0.1', 5000)),
+    'serve.py': ([sys.executable, 'serve.py', '--bind', '127.0.0.1:8000'], ('127.0.0.1', 8000)),
+}
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def wait_for(address, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(address, 1).close()
+            return
+        except socket.error:
+            time.sleep(0.2)
+    raise RuntimeError('server at %s:%d did not come up' % address)
+
+
+def client(base, paths, stop, latencies, errors):
+    i = 0
+    while not stop.is_set():
+        started = time.time()
+        try:
+            urlopen(base + paths[i % len(paths)], timeout=30).read()
+            latencies.append(time.time() - started)
+        except (HTTPError, IOError, socket.error):
+            errors.append(1)
+        i += 1
+
+
+def slow_client(address, stop):
+    try:
+        conn = socket.create_connection(address, 5)
+        conn.send(b'GET / HTTP/1.1\r\nHost: localhost\r\n')
+        while not stop.is_set():
+            conn.send(b'X')
+            stop.wait(1)
+        conn.close()
+    except socket.error:
+        pass
+
+
+def bench(name, paths, clients, slow_clients, duration):
+    command, address = SERVERS[name]
+    env = dict(os.environ, SECRET_KEY=os.environ.get('SECRET_KEY', 'benchmark'))
+    # in a session of its own, so that the reloader child of run.py is
+    # stopped along with it
+    server = subprocess.Popen(command, cwd=ROOT, env=env, preexec_fn=os.setsid,
+                              stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    try:
+        wait_for(address)
+        base = 'http://%s:%d' % address
+        stop = threading.Event()
+        latencies, errors = [], []
+        threads = [threading.Thread(target=slow_client, args=(address, stop))
+                   for i in range(slow_clients)]
+        threads += [threading.Thread(target=client, args=(base, paths, stop, latencies, errors))
+                    for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+
+    print('%-9s %8.1f req/s  p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms  %d errors' % (
+        name, len(latencies) / float(duration),
+        percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+        percentile(latencies, 99) * 1000, len(errors)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare run.py and serve.py under load.')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--slow-clients', type=int, default=0)
+    parser.add_argument('--duration', type=int, default=20, help='seconds per server')
+    parser.add_argument('--paths', nargs='+', default=['/', '/tags/', '/about/'])
+    args = parser.parse_args()
+
+    for name in ('run.py', 'serve.py'):
+        bench(name, args.paths, args.clients, args.slow_clients, args.duration)
+
+
+if __name__ == '__main__':
+    main()
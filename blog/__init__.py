@@ -2,10 +2,12 @@
 
 from flask import Flask
 import logging
+import os
 
 
 app = Flask(__name__)
-app.config.from_object('blog.config.DevConfig')
+app.config.from_object(os.environ.get('BLOG_CONFIG', 'blog.config.DevConfig'))
+app.config.from_envvar('BLOG_SETTINGS', silent=True)
 
 # setup logger
 logger = logging.getLogger('xiaoben')
@@ -15,13 +17,35 @@ ch.setLevel(logging.DEBUG)
 logger.addHandler(ch)
 
 # import releated modules
-from models import create_tables
-from helper import load_settings, generate_csrf_token
+from models import create_tables, db
+from helper import load_settings, generate_csrf_token, comment_token, external_url
+from assets import build_assets
+from compress import CompressMiddleware
 
 # setup CSRF Protection
 app.jinja_env.globals['csrf_token'] = generate_csrf_token
+app.jinja_env.globals['comment_token'] = comment_token
+app.jinja_env.globals['external_url'] = external_url
 
 # setup others
+create_tables()
 load_settings()
+if app.config.get('ASSETS'):
+    build_assets()
+db.close()  # requests open their own connections
+
+# behind nginx, remote_addr (which comments are rate limited by) is the
+# proxy's unless X-Forwarded-For is trusted from that many proxies
+if app.config.get('TRUSTED_PROXIES'):
+    try:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+    except ImportError:  # werkzeug < 0.15
+        from werkzeug.contrib.fixers import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=app.config['TRUSTED_PROXIES'])
+
+if app.config.get('COMPRESS'):
+    app.wsgi_app = CompressMiddleware(app.wsgi_app, min_size=app.config.get('COMPRESS_MIN_SIZE', 500),
+                                      level=app.config.get('COMPRESS_LEVEL', 6))
 
 from blog import views
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+import shutil
+import tempfile
+from flask import request, url_for, send_from_directory
+from blog import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Static files served under names that carry a hash of their content, so
+# browsers may keep them for good: a changed file gets a new name. Text files
+# also get .gz (and .br, with the brotli module) copies compressed once at
+# startup instead of on every request.
+
+BUILD_DIR = app.config.get('ASSETS_DIR', 'assets_build')
+COMPRESSED_TYPES = ('.css', '.js', '.svg', '.txt')
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# static filename -> fingerprinted filename
+manifest = {}
+
+
+def fingerprinted(filename, data):
+    root, ext = os.path.splitext(filename)
+    return '%s.%s%s' % (root, hashlib.sha1(data).hexdigest()[:12], ext)
+
+
+def write_file(filename, data):
+    "Write data to filename atomically, other workers may be building too"
+    directory = os.path.dirname(filename)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        pass  # exists already
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, filename)
+
+
+def gzip_data(data):
+    buf = io.BytesIO()
+    # a fixed mtime keeps the output the same from one build to the next
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def build_assets():
+    "Fingerprint and compress everything in the static folder"
+    manifest.clear()
+    for root, dirs, files in os.walk(app.static_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            built = fingerprinted(filename, data)
+            target = os.path.join(BUILD_DIR, built)
+            # the name says what is inside, so files that exist are up to date
+            if not os.path.exists(target):
+                if name.endswith(COMPRESSED_TYPES):
+                    write_file(target + '.gz', gzip_data(data))
+                    if brotli is not None:
+                        write_file(target + '.br', brotli.compress(data))
+                write_file(target, data)
+
+            manifest[filename] = built
+
+
+def asset_url(filename):
+    "URL of a static file, fingerprinted when the assets are built"
+    if filename in manifest:
+        return url_for('asset', filename=manifest[filename])
+    return url_for('static', filename=filename)
+
+
+app.jinja_env.globals['asset_url'] = asset_url
+
+
+def send_asset(filename):
+    # earlier builds stay too, for pages that still link them
+    encoding = None
+    if filename.endswith(COMPRESSED_TYPES):
+        accepted = request.accept_encodings
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if accepted[candidate] and os.path.exists(os.path.join(BUILD_DIR, filename + suffix)):
+                encoding = candidate
+                break
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding, '')
+    response = send_from_directory(os.path.abspath(BUILD_DIR), filename + suffix, mimetype=mimetype)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if filename.endswith(COMPRESSED_TYPES):
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def copy_assets(output):
+    "Copy the built assets, compressed copies included, to output"
+    for root, dirs, files in os.walk(BUILD_DIR):
+        target = os.path.join(output, os.path.relpath(root, BUILD_DIR))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            shutil.copy2(os.path.join(root, name), os.path.join(target, name))
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from flask import request, session, g
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+from blog import app
+
+
+class Stamp(object):
+    """
+    A file whose modification time tells all processes that something they
+    share changed, at the cost of a stat() per check, like SETTINGS_STAMP.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def version(self):
+        if self.path is None:
+            return None
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def touch(self):
+        if self.path is not None:
+            with open(self.path, 'a'):
+                os.utime(self.path, None)
+
+
+class LRUCache(object):
+    """
+    A small thread-safe LRU mapping with an optional time-to-live. With a
+    stamp it empties itself whenever the stamp was touched since.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, stamp=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stamp = stamp
+        self._seen = stamp.version() if stamp is not None else None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        if self.stamp is not None:
+            version = self.stamp.version()
+            if version != self._seen:
+                self.clear()  # another process changed something
+                self._seen = version
+        with self._lock:
+            try:
+                value, stored_at = self._data.pop(key)
+            except KeyError:
+                return default
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                return default
+            self._data[key] = (value, stored_at)  # mark as recently used
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def delete_matching(self, predicate):
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+
+# Touched on every change of content, so that the caches each process keeps
+# in memory drop what the other processes changed.
+content_stamp = Stamp(app.config.get('PAGE_CACHE_STAMP'))
+
+
+# Full page cache for anonymous readers.
+#
+# Keys are (group, query_string) pairs where the group identifies an endpoint
+# together with its view arguments, e.g. one article's detail page, so that a
+# single page can be dropped regardless of the query strings it was seen with.
+
+def page_key(endpoint, view_args, query_string):
+    group = repr((endpoint, sorted((view_args or {}).items())))
+    return group, query_string
+
+
+class MemoryPageCache(object):
+    """
+    Pages kept in this process, least recently used ones evicted first. All
+    of them are dropped once another process touched the stamp.
+    """
+
+    def __init__(self, maxsize=1000, stamp=None):
+        self._cache = LRUCache(maxsize, stamp=stamp)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, entry):
+        self._cache.set(key, entry)
+
+    def delete_group(self, group):
+        self._cache.delete_matching(lambda key: key[0] == group)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class FilePageCache(object):
+    """
+    Pages pickled into a local directory, shared by all workers on the host.
+    Once in a while the oldest pages beyond maxsize are removed, so that
+    made up query strings can't fill the disk.
+    """
+
+    def __init__(self, path, maxsize=1000):
+        self.path = path
+        self.maxsize = maxsize
+        self._sets = 0
+
+    def _group_dir(self, group):
+        return os.path.join(self.path, hashlib.sha1(group.encode('utf-8')).hexdigest())
+
+    def _filename(self, key):
+        group, query_string = key
+        name = hashlib.sha1(query_string).hexdigest()
+        return os.path.join(self._group_dir(group), name)
+
+    def get(self, key):
+        try:
+            with open(self._filename(key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def set(self, key, entry):
+        filename = self._filename(key)
+        directory = os.path.dirname(filename)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # exists already
+        # write to a temporary file first so that readers never see half a page
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, filename)
+
+        self._sets += 1
+        if self._sets >= max(self.maxsize // 10, 1):
+            self._sets = 0
+            self.evict()
+
+    def evict(self):
+        "Remove the oldest pages beyond maxsize"
+        pages = []
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                filename = os.path.join(root, name)
+                try:
+                    pages.append((os.stat(filename).st_mtime, filename))
+                except OSError:
+                    pass  # removed meanwhile
+        pages.sort()
+        for mtime, filename in pages[:max(len(pages) - self.maxsize, 0)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def delete_group(self, group):
+        shutil.rmtree(self._group_dir(group), ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def create_page_cache(config):
+    backend = config.get('PAGE_CACHE')
+    if backend == 'memory':
+        return MemoryPageCache(config.get('PAGE_CACHE_SIZE', 1000), content_stamp)
+    if backend == 'file':
+        return FilePageCache(config.get('PAGE_CACHE_DIR', 'page_cache'),
+                             config.get('PAGE_CACHE_SIZE', 1000))
+    return None
+
+
+page_cache = create_page_cache(app.config)
+
+
+# Invalidation. Views report every change of site content through
+# content_changed() and the caches registered with @invalidator drop whatever
+# depends on it, after content_stamp is touched for the other processes. kind
+# is one of 'article', 'comment', 'category' or 'settings'.
+
+_invalidators = []
+
+
+# Conditional GET. A view describes the data its page is rendered from with
+# not_modified(version); the ETag then also covers everything else the page
+# depends on: the user, the session's CSRF token and settings. There is no
+# Last-Modified: nothing records when an article was edited or deleted, or
+# when its neighbours changed, so If-Modified-Since alone can't be answered.
+
+def make_version(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def page_etag(version):
+    user = current_user.get_id() if current_user.is_authenticated else None
+    return make_version(version, user, session.get('_csrf_token'),
+                        app.jinja_env.globals.get('blog_title'),
+                        app.jinja_env.globals.get('blog_nickname'),
+                        app.jinja_env.globals.get('blog_description'))
+
+
+def not_modified(version):
+    """
+    Remember the validators of the page about to be rendered and return a
+    304 response if the client's copy is still up to date, None otherwise.
+    """
+    if '_flashes' in session:
+        return None  # the page will show (and consume) the messages
+
+    g.page_validators = version
+    if is_resource_modified(request.environ, etag=page_etag(version)):
+        return None
+    return set_validators(app.response_class(status=304))
+
+
+def set_validators(response):
+    version = g.get('page_validators')
+    if version is not None and response.status_code in (200, 304):
+        # compressed bodies differ from the one the tag stands for
+        response.set_etag(page_etag(version), weak='Content-Encoding' in response.headers)
+        # pages carry a per-session token, so only the browser may keep them
+        # and it has to ask us before reusing them
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+def invalidator(func):
+    _invalidators.append(func)
+    return func
+
+
+def content_changed(kind, article=None):
+    content_stamp.touch()
+    for func in _invalidators:
+        func(kind, article)
+
+
+@invalidator
+def invalidate_pages(kind, article=None):
+    if page_cache is None:
+        return
+    if kind == 'comment' and article is not None:
+        # comments only show up on the article's own page
+        group, _ = page_key('detail', {'slug': article.slug}, b'')
+        page_cache.delete_group(group)
+    else:
+        page_cache.clear()
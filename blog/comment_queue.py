@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+import atexit
+import os
+import threading
+import time
+
+try:
+    import Queue as queue  # python 2
+except ImportError:
+    import queue
+
+from blog import app, logger
+from models import db, Comment
+from cache import LRUCache, content_changed
+from metrics import registry
+
+# Comments are accepted into a bounded queue and written by a background
+# thread, many per transaction, so that a burst of them doesn't queue up on
+# sqlite's write lock in front of everything else. Every worker process has
+# its own queue and its own rate limits.
+
+registry.describe('blog_comments_written_total', 'counter', 'Comments written to the database.')
+registry.describe('blog_comments_dropped_total', 'counter', 'Comments refused because the queue was full.')
+registry.describe('blog_comments_rate_limited_total', 'counter', 'Comments refused by the rate limiter.')
+registry.describe('blog_comment_write_errors_total', 'counter', 'Failed attempts to write a batch of comments.')
+
+# a batch is tried again after 1, 2, 4... seconds before it's given up
+WRITE_ATTEMPTS = 4
+
+
+class RateLimiter(object):
+    """
+    A token bucket per key: burst tokens to start with, refilled at rate
+    tokens per second, one taken by every allowed call. Buckets of keys
+    that haven't been seen for a while are evicted by the LRU.
+    """
+
+    def __init__(self, rate, burst, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets.set(key, (tokens, now))
+        return allowed
+
+
+class CommentQueue(object):
+
+    def __init__(self, maxsize, batch_size, interval):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _ensure_started(self):
+        # started on first use, and again in a forked worker, which inherits
+        # the queue but not the thread emptying it
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue(self.maxsize)
+                self._thread = threading.Thread(target=self._run, name='comment-queue')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def depth(self):
+        if self._pid != os.getpid():
+            return 0
+        return self._queue.qsize()
+
+    def submit(self, row, article):
+        "Queue a comment for article, False if the queue is full"
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((row, article))
+        except queue.Full:
+            registry.inc('blog_comments_dropped_total')
+            return False
+        return True
+
+    def _next_batch(self):
+        "Wait for a comment, then take those arriving within interval with it"
+        batch = [self._queue.get()]
+        deadline = time.time() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _queued_batch(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self.write(self._next_batch(), attempts=WRITE_ATTEMPTS)
+
+    def _insert(self, batch):
+        opened = db.is_closed()
+        try:
+            if opened:
+                db.connect()
+            with db.atomic():
+                Comment.insert_many([row for row, article in batch]).execute()
+        finally:
+            if opened:
+                db.close()
+
+    def write(self, batch, attempts=1):
+        """
+        Write a batch of comments, trying again after a pause when the
+        database is busy or failing. Returns whether they were written; the
+        comments that couldn't be are logged, so they can be restored.
+        """
+        if not batch:
+            return True
+        for attempt in range(attempts):
+            try:
+                self._insert(batch)
+                break
+            except Exception:
+                registry.inc('blog_comment_write_errors_total')
+                logger.exception('failed to write %d comments (attempt %d of %d)',
+                                 len(batch), attempt + 1, attempts)
+                if attempt + 1 < attempts:
+                    time.sleep(2 ** attempt)
+        else:
+            logger.error('lost %d comments: %r', len(batch), [row for row, article in batch])
+            return False
+
+        registry.inc('blog_comments_written_total', len(batch))
+        articles = dict((article.id, article) for row, article in batch)
+        for article in articles.values():
+            content_changed('comment', article)
+        return True
+
+    def flush(self):
+        "Write whatever is queued from the calling thread"
+        if self._pid != os.getpid():
+            return
+        while True:
+            batch = self._queued_batch()
+            if not batch:
+                break
+            self.write(batch, attempts=WRITE_ATTEMPTS)
+
+
+comment_queue = CommentQueue(app.config.get('COMMENT_QUEUE_SIZE', 1000),
+                             app.config.get('COMMENT_BATCH_SIZE', 100),
+                             app.config.get('COMMENT_FLUSH_INTERVAL', 0.5))
+comment_limiter = RateLimiter(app.config.get('COMMENT_RATE', 0.05),
+                              app.config.get('COMMENT_BURST', 3))
+
+# the daemon thread dies with the process, so what is left is written here
+atexit.register(comment_queue.flush)
+
+
+@registry.gauge('blog_comment_queue_depth', 'Comments waiting to be written.')
+def queue_depth():
+    return comment_queue.depth()
+
+
+def submit_comment(row, article, client):
+    """
+    Accept a comment from client (its address) for later writing, or write
+    it right away without COMMENT_WRITE_BEHIND. Returns (accepted, message
+    for the commenter).
+    """
+    if not comment_limiter.allow((client, article.id)):
+        registry.inc('blog_comments_rate_limited_total')
+        return False, 'Too many comments, please wait a moment.'
+    if not app.config.get('COMMENT_WRITE_BEHIND', True):
+        if not comment_queue.write([(row, article)]):
+            return False, 'Your comment could not be saved, please try again later.'
+        return True, None
+    if not comment_queue.submit(row, article):
+        return False, 'Too many comments right now, please try again later.'
+    return True, 'Thanks! Your comment will appear in a moment.'
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import zlib
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# content types worth compressing, everything else is left alone
+COMPRESSIBLE_TYPES = ('text/html', 'text/xml', 'application/xml', 'application/atom+xml',
+                      'application/json')
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS  # a gzip header instead of a zlib one
+
+
+def compressible(content_type):
+    return (content_type or '').split(';')[0].strip().lower() in COMPRESSIBLE_TYPES
+
+
+def negotiate(accept_encoding, streaming=False):
+    "The best encoding the client accepts, None for the identity"
+    accepted = parse_accept_header(accept_encoding or '')
+    candidates = []
+    # the brotli module may be too old to compress a stream
+    if brotli is not None and (not streaming or hasattr(brotli, 'Compressor')):
+        candidates.append('br')
+    candidates.append('gzip')
+    for encoding in candidates:
+        if accepted[encoding]:
+            return encoding
+    return None
+
+
+def compress_body(data, encoding, level=6, best=False):
+    """
+    Compress a whole body. best spends more time for a smaller result, for
+    bodies that are compressed once and sent many times.
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else min(level, 11))
+    compressor = zlib.compressobj(9 if best else level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def weak_etag(headers):
+    # the compressed representation isn't byte for byte the one tagged
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        headers['ETag'] = 'W/' + etag
+
+
+class Compressor(object):
+    "Compresses a stream, sending every chunk as soon as it is compressed"
+
+    def __init__(self, encoding, level):
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=min(level, 11))
+            self._flush = self._compressor.flush
+            self._finish = self._compressor.finish
+            self._compress = self._compressor.process
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+            self._flush = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = self._compressor.flush
+            self._compress = self._compressor.compress
+
+    def compress(self, chunk):
+        return self._compress(chunk) + self._flush()
+
+    def finish(self):
+        return self._finish()
+
+
+class CompressMiddleware(object):
+    """
+    WSGI middleware compressing html, xml and json responses with gzip or
+    brotli, whichever the client prefers. Bodies of a known length are
+    compressed at once when they are at least min_size bytes long; streamed
+    ones chunk by chunk. Responses that are encoded already, like the
+    precompressed assets and cached pages, are passed on untouched.
+    """
+
+    def __init__(self, app, min_size=500, level=6):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        started = {}
+
+        def capture(status, headers, exc_info=None):
+            started.update(status=status, headers=headers, exc_info=exc_info)
+            return lambda data: None  # the write() callable, unused by werkzeug
+
+        # werkzeug starts the response before it returns the body
+        app_iter = self.app(environ, capture)
+        headers = Headers(started['headers'])
+        status = started['status']
+
+        if (environ.get('REQUEST_METHOD') == 'HEAD' or not status.startswith('200') or
+                not compressible(headers.get('Content-Type')) or 'Content-Encoding' in headers or
+                'no-transform' in headers.get('Cache-Control', '')):
+            start_response(status, started['headers'], started['exc_info'])
+            return app_iter
+
+        headers.add('Vary', 'Accept-Encoding')
+        length = headers.get('Content-Length', type=int)
+        encoding = negotiate(environ.get('HTTP_ACCEPT_ENCODING'), streaming=length is None)
+        if encoding is None or (length is not None and length < self.min_size):
+            start_response(status, headers.to_wsgi_list(), started['exc_info'])
+            return app_iter
+
+        headers['Content-Encoding'] = encoding
+        weak_etag(headers)
+        if length is not None:
+            try:
+                body = b''.join(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            body = compress_body(body, encoding, self.level)
+            headers['Content-Length'] = str(len(body))
+            start_response(status, headers.to_wsgi_list(), started['exc_info'])
+            return [body]
+
+        start_response(status, headers.to_wsgi_list(), started['exc_info'])
+        return self._stream(app_iter, Compressor(encoding, self.level))
+
+    def _stream(self, app_iter, compressor):
+        try:
+            for chunk in app_iter:
+                if chunk:
+                    data = compressor.compress(chunk)
+                    if data:
+                        yield data
+            yield compressor.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
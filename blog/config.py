@@ -1,9 +1,73 @@
 #!/usr/bin/env python
 
+import os
+
+
 class Config(object):
     DEBUG = False
     TESTING = False
     PER_PAGE = 10
+    DATABASE = 'blog.db'
+    # WAL lets readers carry on while a comment or an edit is being written
+    DATABASE_PRAGMAS = (
+        ('journal_mode', 'wal'),
+        ('synchronous', 'normal'),
+        ('cache_size', -16000),  # KiB
+        ('mmap_size', 64 * 1024 * 1024),
+    )
+    DATABASE_TIMEOUT = 10  # seconds to wait for a locked database
+    DATABASE_POOL = False
+    DATABASE_MAX_CONNECTIONS = 8
+    DATABASE_STALE_TIMEOUT = 300
+    # touched whenever the settings are saved
+    SETTINGS_STAMP = 'blog.db.settings'
+    MARKDOWN_CACHE_SIZE = 512
+    FULL_TEXT_SEARCH = True  # used when sqlite has FTS5
+    COMMENTS_PER_PAGE = 50  # threads per page
+    COMMENT_CACHE_SIZE = 256  # articles
+    # full page cache for anonymous readers: None, 'memory' or 'file'
+    PAGE_CACHE = 'memory'
+    PAGE_CACHE_SIZE = 1000  # pages, for both backends
+    # touched on every change so that the other processes drop their memory
+    # caches: pages, neighbours and page counts
+    PAGE_CACHE_STAMP = 'blog.db.pages'
+    PAGE_CACHE_DIR = 'page_cache'
+    # 'offset' numbers the pages, 'keyset' seeks by (post_date, id) cursors
+    PAGINATION = 'keyset'
+    USER_CACHE_TTL = 300
+    FEED_SIZE = 20  # articles per Atom feed
+    FEED_CACHE_TTL = 60  # seconds aggregators may keep a feed
+    SITEMAP_SIZE = 10000  # articles per sitemap file, at most 50000
+    SITEMAP_CACHE_DIR = 'sitemap_cache'
+    # scheme and host of the blog, for the absolute links of sitemaps and
+    # feeds, which are cached and must not come from a request's Host header
+    SITE_URL = 'http://localhost:5000'
+    # static files under content hashed names, precompressed, cached for good
+    ASSETS = True
+    ASSETS_DIR = 'assets_build'
+    # highlight code blocks with pygments when rendering markdown, in place
+    # of highlight.js in the browser
+    SERVER_HIGHLIGHT = True
+    # comments are written by a background thread, in batches
+    COMMENT_WRITE_BEHIND = True
+    COMMENT_QUEUE_SIZE = 1000
+    COMMENT_BATCH_SIZE = 100  # rows per insert, keep it below 999 / 7 for sqlite
+    COMMENT_FLUSH_INTERVAL = 0.5  # seconds a batch waits for more comments
+    # per reader and article: COMMENT_BURST comments, then one every 1 / COMMENT_RATE seconds
+    COMMENT_RATE = 0.05
+    COMMENT_BURST = 3
+    COMMENT_TOKEN_WINDOW = 86400  # seconds a comment form token lasts, at least
+    # proxies in front of the application whose X-Forwarded-For is believed,
+    # 1 behind nginx; readers are told apart by address
+    TRUSTED_PROXIES = 0
+    # gzip or brotli for html, xml and json responses of at least COMPRESS_MIN_SIZE bytes
+    COMPRESS = True
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_LEVEL = 6
+    # per process query, markdown and template timings, a Server-Timing
+    # header and /metrics for Prometheus
+    METRICS = True
+    SLOW_REQUEST_THRESHOLD = 0.5  # seconds, None to log nothing
 
 
 class DevConfig(Config):
@@ -19,4 +83,5 @@ class TestingConfig(Config):
 
 
 class ProductionConfig(Config):
-    pass
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    SITE_URL = os.environ.get('SITE_URL')
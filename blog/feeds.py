@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import threading
+from flask import render_template
+from blog import app
+from models import Article, ArticleTagThrough, Tag
+from cache import LRUCache, invalidator, make_version, content_stamp
+
+# Serialized Atom feeds by tag name, None for the whole site. Aggregators poll
+# them far more often than anything changes, so a feed is built once per
+# change, in this process or, through content_stamp, in another one. Their
+# links are under SITE_URL, as the feeds are shared by whatever host asked.
+feed_cache = LRUCache(256, stamp=content_stamp)
+
+# one request builds a missing feed while the others wait for it
+_build_lock = threading.Lock()
+
+
+@invalidator
+def invalidate_feeds(kind, article=None):
+    # articles, their categories and the blog title all show up in feeds
+    if kind != 'comment':
+        feed_cache.clear()
+
+
+class Feed(object):
+
+    def __init__(self, body, etag, updated):
+        self.body = body
+        self.etag = etag
+        self.updated = updated
+
+
+def build_feed(tag=None):
+    if tag is not None and not Tag.select().where(Tag.name == tag).exists():
+        return None
+
+    query = Article.public()
+    if tag is not None:
+        query = query.join(ArticleTagThrough).join(Tag).where(Tag.name == tag)
+    query = (query
+             .order_by(Article.post_date.desc(), Article.id.desc())
+             .limit(app.config.get('FEED_SIZE', 20)))
+    object_list = Article.with_tags(query)
+
+    updated = max([article.post_date for article in object_list] or [None])
+    body = render_template('feed.xml', tag=tag, object_list=object_list, updated=updated)
+    return Feed(body.encode('utf-8'), make_version(body), updated)
+
+
+def get_feed(tag=None):
+    "The cached feed of the newest public articles, None for unknown tags"
+    feed = feed_cache.get(tag)
+    if feed is None:
+        with _build_lock:
+            feed = feed_cache.get(tag)
+            if feed is None:
+                feed = build_feed(tag)
+                if feed is not None:
+                    feed_cache.set(tag, feed)
+    return feed
@@ -1,13 +1,33 @@
 #!/usr/bin/env python
 
 from blog import app
-from flask import session
+from flask import session, request, url_for
 from models import Profile
+from cache import content_changed
+import hashlib
+import hmac
+import os
 import string
 import random
+import time
+
+
+# Every process keeps its own copy of the settings. Saving them touches the
+# SETTINGS_STAMP file, and the other processes reload theirs once they see
+# its modification time change, which costs a stat() per request.
+loaded_version = None
+
+
+def settings_version():
+    try:
+        return os.stat(app.config['SETTINGS_STAMP']).st_mtime
+    except OSError:
+        return None
 
 
 def load_settings():
+    global loaded_version
+    loaded_version = settings_version()
     try:
         settings = Profile.select()[0]
         app.jinja_env.globals['blog_title'] = settings.blog_title
@@ -20,6 +40,31 @@ def load_settings():
         app.config.update(INSTALL=True)
 
 
+def save_settings():
+    "Reload the settings here and tell the other processes to do the same"
+    with open(app.config['SETTINGS_STAMP'], 'a'):
+        os.utime(app.config['SETTINGS_STAMP'], None)
+    load_settings()
+    content_changed('settings')
+
+
+def refresh_settings():
+    "Reload the settings if another process saved them"
+    # the caches of this process follow by themselves, as the saving process
+    # touched content_stamp and cleared the shared ones
+    if settings_version() != loaded_version:
+        load_settings()
+
+
+def external_url(endpoint, **values):
+    "Absolute URL of a page under SITE_URL, whatever host the request was for"
+    if endpoint == 'index':
+        path = request.script_root + '/'  # url_for builds /index
+    else:
+        path = url_for(endpoint, **values)
+    return app.config['SITE_URL'].rstrip('/') + path
+
+
 def random_string():
     chars = string.ascii_uppercase + string.digits + string.ascii_lowercase
     return ''.join(random.choice(chars) for i in range(24))
@@ -29,3 +74,31 @@ def generate_csrf_token():
     if '_csrf_token' not in session:
         session['_csrf_token'] = random_string()
     return session['_csrf_token']
+
+
+# Readers comment without an account, so the comment form doesn't need a
+# token bound to a session, only one showing that the form of this article
+# came from this blog lately. It is the same for every reader, which keeps
+# detail pages cacheable as a whole, compressed copies included. It changes
+# every COMMENT_TOKEN_WINDOW seconds and the previous one is still accepted.
+# Every other form keeps the session's token from generate_csrf_token().
+
+def comment_token_window():
+    return int(time.time() // app.config.get('COMMENT_TOKEN_WINDOW', 86400))
+
+
+def comment_token(slug, window=None):
+    if window is None:
+        window = comment_token_window()
+    key = app.secret_key
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    message = ('comment-form:%d:%s' % (window, slug)).encode('utf-8')
+    return hmac.new(key, message, hashlib.sha1).hexdigest()
+
+
+def check_comment_token(token, slug):
+    window = comment_token_window()
+    token = (token or '').encode('utf-8')
+    return any(hmac.compare_digest(token, comment_token(slug, w).encode('utf-8'))
+               for w in (window, window - 1))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import request, g, has_request_context
+from jinja2 import Template
+from blog import app, logger
+
+# upper bounds, in seconds, of the request duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# statements remembered per request for the slow request log
+MAX_LOGGED_QUERIES = 100
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in labels)
+
+
+class Registry(object):
+    """
+    Counters, histograms and gauges of this process, rendered in the
+    Prometheus text format. Every worker keeps its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = OrderedDict()  # name -> (type, help, {labels: value})
+        self._gauges = OrderedDict()   # name -> (help, function)
+
+    def describe(self, name, type, help):
+        self._metrics.setdefault(name, (type, help, {}))
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._metrics[name][2]
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        "Count value into the buckets of a histogram"
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._metrics[name][2]
+            buckets, count, total = values.get(key, ((0,) * len(BUCKETS), 0, 0.0))
+            buckets = tuple(n + (value <= bound) for n, bound in zip(buckets, BUCKETS))
+            values[key] = (buckets, count + 1, total + value)
+
+    def gauge(self, name, help):
+        "Register a function returning the current value of a gauge"
+        def decorator(func):
+            self._gauges[name] = (help, func)
+            return func
+        return decorator
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (type, help, values) in self._metrics.items():
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, type))
+                for key, value in sorted(values.items()):
+                    if type != 'histogram':
+                        lines.append('%s%s %r' % (name, _labels(key), value))
+                        continue
+                    buckets, count, total = value
+                    for n, bound in zip(buckets, BUCKETS):
+                        lines.append('%s_bucket%s %d' % (name, _labels(key + (('le', bound),)), n))
+                    lines.append('%s_bucket%s %d' % (name, _labels(key + (('le', '+Inf'),)), count))
+                    lines.append('%s_sum%s %r' % (name, _labels(key), total))
+                    lines.append('%s_count%s %d' % (name, _labels(key), count))
+        for name, (help, func) in self._gauges.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %r' % (name, func()))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+registry.describe('blog_requests_total', 'counter', 'Requests answered, by endpoint and status.')
+registry.describe('blog_request_duration_seconds', 'histogram', 'Time spent answering requests.')
+
+# what record() measures: kind -> (name of the counter, what it counts)
+KINDS = OrderedDict([
+    ('db', ('blog_sql_queries', 'SQL statements executed')),
+    ('markdown', ('blog_markdown_renders', 'Markdown documents converted to html')),
+    ('template', ('blog_template_renders', 'Templates rendered')),
+])
+
+for _name, _help in KINDS.values():
+    registry.describe(_name + '_total', 'counter', _help + '.')
+    registry.describe(_name + '_seconds_total', 'counter', 'Time spent on ' + _help.lower() + '.')
+
+
+class RequestTiming(object):
+    "What the current request spent its time on"
+
+    def __init__(self):
+        self.started = time.time()
+        self.counts = dict((kind, 0) for kind in KINDS)
+        self.durations = dict((kind, 0.0) for kind in KINDS)
+        self.queries = []
+
+    def add(self, kind, seconds, statement=None):
+        self.counts[kind] += 1
+        self.durations[kind] += seconds
+        if statement is not None and len(self.queries) < MAX_LOGGED_QUERIES:
+            self.queries.append((seconds, statement))
+
+    def server_timing(self, elapsed):
+        parts = ['%s;dur=%.2f;desc="%d"' % (kind, self.durations[kind] * 1000, self.counts[kind])
+                 for kind in KINDS]
+        parts.append('total;dur=%.2f' % (elapsed * 1000))
+        return ', '.join(parts)
+
+
+def record(kind, seconds, statement=None, **labels):
+    name = KINDS[kind][0]
+    registry.inc(name + '_total', **labels)
+    registry.inc(name + '_seconds_total', seconds, **labels)
+    if has_request_context():
+        timing = g.get('request_timing')
+        if timing is not None:
+            timing.add(kind, seconds, statement)
+
+
+@contextmanager
+def timed(kind, **labels):
+    started = time.time()
+    try:
+        yield
+    finally:
+        record(kind, time.time() - started, **labels)
+
+
+class QueryTimer(object):
+    """
+    Database mixin counting and timing every statement. Rows fetched
+    lazily after execute_sql() returns are not part of the time.
+    """
+
+    def execute_sql(self, sql, *args, **kwargs):
+        started = time.time()
+        try:
+            return super(QueryTimer, self).execute_sql(sql, *args, **kwargs)
+        finally:
+            record('db', time.time() - started, statement=sql)
+
+
+def instrumented(database_class):
+    "A subclass of database_class whose statements are counted and timed"
+    return type(database_class.__name__, (QueryTimer, database_class), {})
+
+
+class TimedTemplate(Template):
+
+    def render(self, *args, **kwargs):
+        with timed('template', template=self.name or 'string'):
+            return super(TimedTemplate, self).render(*args, **kwargs)
+
+
+def log_slow_request(timing, elapsed):
+    queries = '\n'.join('  %8.2f ms  %s' % (seconds * 1000, statement)
+                        for seconds, statement in timing.queries)
+    logger.warning('slow request: %s %s took %.0f ms, %d queries in %.0f ms, '
+                   'markdown %.0f ms, templates %.0f ms\n%s',
+                   request.method, request.full_path, elapsed * 1000,
+                   timing.counts['db'], timing.durations['db'] * 1000,
+                   timing.durations['markdown'] * 1000, timing.durations['template'] * 1000,
+                   queries)
+
+
+def enabled():
+    return app.config.get('METRICS', False)
+
+
+if enabled():
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def start_timing():
+        g.request_timing = RequestTiming()
+
+    @app.after_request
+    def finish_timing(response):
+        timing = g.get('request_timing')
+        if timing is None:
+            return response
+        elapsed = time.time() - timing.started
+        endpoint = request.endpoint or 'none'
+        registry.inc('blog_requests_total', endpoint=endpoint, method=request.method,
+                     status=response.status_code)
+        registry.observe('blog_request_duration_seconds', elapsed, endpoint=endpoint)
+        response.headers['Server-Timing'] = timing.server_timing(elapsed)
+
+        threshold = app.config.get('SLOW_REQUEST_THRESHOLD')
+        if threshold is not None and elapsed >= threshold:
+            log_slow_request(timing, elapsed)
+        return response
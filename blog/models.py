@@ -1,16 +1,66 @@
 #!/usr/bin/env python
 
 import datetime
+import functools
+import hashlib
+import json
+import operator
 import os
 import re
+from collections import OrderedDict
 from peewee import *
+from playhouse.sqlite_ext import SqliteExtDatabase, FTS5Model, SearchField, RowIDField
 from markdown import markdown
-from blog import app
+from blog import app, logger
+from cache import LRUCache, invalidator, content_stamp
+from metrics import instrumented, timed
+from flask import Markup, escape
 from werkzeug.security import generate_password_hash, check_password_hash
 import pinyin
 
-
-db = SqliteDatabase('blog.db')
+try:
+    import pygments
+except ImportError:
+    pygments = None
+
+
+def create_database(config):
+    # the sqlite_ext flavours, since ArticleIndex is an FTS5 virtual table
+    options = dict(pragmas=config.get('DATABASE_PRAGMAS', ()),
+                   timeout=config.get('DATABASE_TIMEOUT', 10))
+    if config.get('DATABASE_POOL'):
+        from playhouse.pool import PooledSqliteExtDatabase as database_class
+        options.update(max_connections=config.get('DATABASE_MAX_CONNECTIONS'),
+                       stale_timeout=config.get('DATABASE_STALE_TIMEOUT'))
+    else:
+        database_class = SqliteExtDatabase
+    if config.get('METRICS'):
+        database_class = instrumented(database_class)
+    return database_class(config['DATABASE'], **options)
+
+
+db = create_database(app.config)
+
+MARKDOWN_EXTENSIONS = ['markdown.extensions.extra']
+MARKDOWN_EXTENSION_CONFIGS = {}
+if app.config.get('SERVER_HIGHLIGHT') and pygments is not None:
+    # code blocks are highlighted once, when they are rendered, instead of
+    # by highlight.js in every browser
+    MARKDOWN_EXTENSIONS.append('markdown.extensions.codehilite')
+    MARKDOWN_EXTENSION_CONFIGS['markdown.extensions.codehilite'] = {
+        'css_class': 'codehilite',
+        'guess_lang': True,  # like highlight.js, for blocks without a language
+    }
+else:
+    app.config.update(SERVER_HIGHLIGHT=False)
+MORE_TAGS = ('<!-- more -->', '<!--more-->')
+
+# rendered html keyed by markdown_key(), in front of the RenderedMarkdown table
+markdown_cache = LRUCache(app.config.get('MARKDOWN_CACHE_SIZE', 512))
+
+# users by id for flask-login, which loads the user on every request of the
+# author. Other processes see changes when USER_CACHE_TTL runs out.
+user_cache = LRUCache(64, ttl=app.config.get('USER_CACHE_TTL', 300))
 
 
 class BaseModel(Model):
@@ -25,7 +75,7 @@ class User(BaseModel):
     email = CharField()
     nickname = CharField()
     role = IntegerField(default=1)
-    join_date = DateTimeField(default=datetime.datetime.now())
+    join_date = DateTimeField(default=datetime.datetime.now)
 
     class Meta:
         order_by = ('username',)
@@ -49,8 +99,25 @@ class User(BaseModel):
             return str(self.id)  # python 3
 
     def save(self, *args, **kwargs):
-        self.password = generate_password_hash(self.password)
-        return super(User, self).save(*args, **kwargs)
+        # only a new password is plain text, the stored one is hashed already
+        if any(field.name == 'password' for field in self.dirty_fields):
+            self.password = generate_password_hash(self.password)
+        result = super(User, self).save(*args, **kwargs)
+        user_cache.delete(self.id)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        user_cache.delete(self.id)
+        return super(User, self).delete_instance(*args, **kwargs)
+
+    @classmethod
+    def cached(cls, id):
+        "The user with this id, from the cache if it was loaded recently"
+        user = user_cache.get(id)
+        if user is None:
+            user = cls.get(cls.id == id)
+            user_cache.set(id, user)
+        return user
 
     def check_password(self, password):
         return check_password_hash(self.password, password)
@@ -65,74 +132,179 @@ class Category(BaseModel):
     def __str__(self):
         return self.name
 
-    @property
-    def articles(self):
-        return self.articles
-
     @property
     def article_count(self):
+        # set by with_counts(), otherwise count the articles of this category
+        count = getattr(self, 'num_articles', None)
+        if count is not None:
+            return count
         return self.articles.count()
 
+    @classmethod
+    def with_counts(cls):
+        "All categories with the number of their articles, in a single query"
+        return (Category
+                .select(Category, fn.COUNT(Article.id).alias('num_articles'))
+                .join(Article, JOIN.LEFT_OUTER)
+                .group_by(Category))
+
 
 class Article(BaseModel):
     title = CharField()
     slug = CharField(unique=True)
     content = TextField()
     is_published = BooleanField(default=True, index=True)
-    post_date = DateTimeField(default=datetime.datetime.now(), index=True)
+    post_date = DateTimeField(default=datetime.datetime.now, index=True)
 
     author = ForeignKeyField(User)
     category = ForeignKeyField(Category, related_name="articles")
 
     class Meta:
         order_by = ('-post_date',)
+        indexes = (
+            # keyset pagination seeks on this pair
+            (('post_date', 'id'), False),
+        )
 
     @property
     def tags(self):
+        prefetched = getattr(self, '_prefetched_tags', None)
+        if prefetched is not None:
+            return prefetched
         return Tag.select().join(ArticleTagThrough).where(ArticleTagThrough.article == self.id)
 
     @property
     def html(self):
         "Convert markdown content to html"
-        return markdown(self.content, ['markdown.extensions.extra'])
+        return render_markdown(self.content)
 
     @property
     def abstract(self):
-        # is there a tag: <!-- more --> or <!--more--> ?
-        index = self.content.find('<!-- more -->')
-        if index != -1:
-            return markdown(self.content[:index], ['markdown.extensions.extra'])
-
-        index = self.content.find('<!--more-->')
-        if index != -1:
-            return markdown(self.content[:index], ['markdown.extensions.extra'])
-
-        return None
+        source = self._abstract_markdown()
+        if source is None:
+            return None
+        return render_markdown(source)
+
+    def _abstract_markdown(self):
+        return abstract_markdown(self.content)
+
+    def fingerprint(self, with_category=False):
+        """
+        Everything about this article that shows up on its pages, the name of
+        its category too for pages showing it, which have it joined in
+        """
+        fingerprint = (self.id, self.slug, self.title, markdown_key(self.content),
+                       self.post_date, self.is_published, self.category_id,
+                       [tag.name for tag in self.tags])
+        if with_category:
+            fingerprint += (self.category.name,)
+        return fingerprint
+
+    def set_tags(self, tags):
+        "Link this article to exactly the given tags"
+        wanted = set(tag.id for tag in tags)
+        linked = set(tag_id for tag_id, in ArticleTagThrough
+                     .select(ArticleTagThrough.tag)
+                     .where(ArticleTagThrough.article == self.id)
+                     .tuples())
+
+        added = wanted - linked
+        if added:
+            ArticleTagThrough.insert_many(
+                [{'article': self.id, 'tag': tag_id} for tag_id in added]).execute()
+
+        removed = linked - wanted
+        if removed:
+            (ArticleTagThrough
+             .delete()
+             .where((ArticleTagThrough.article == self.id) &
+                    (ArticleTagThrough.tag << list(removed)))
+             .execute())
+
+        self._prefetched_tags = sorted(tags, key=lambda tag: tag.name)
+
+    def neighbours(self, public_only=True):
+        "Slugs of the newer and of the older article next to this one"
+        order = article_order(public_only)
+        if self.id not in order.positions:
+            # created by another process since the order was cached
+            neighbour_cache.delete(public_only)
+            order = article_order(public_only)
+
+        i = order.positions.get(self.id)
+        if i is None:
+            return None, None
+        newer = order.slugs[i - 1] if i > 0 else None
+        older = order.slugs[i + 1] if i + 1 < len(order.slugs) else None
+        return newer, older
+
+    def prerender(self):
+        "Render html and abstract now so that readers never pay for markdown"
+        self.html
+        self.abstract
 
     def save(self, *args, **kwargs):
+        # index=False leaves the search index to the caller, e.g. until the
+        # tags are set
+        index = kwargs.pop('index', True)
+
         # Generate a URL-friendly representation of the entry's title.
-        if not self.slug:
-            self.slug = re.sub('[^\w]+', '-', self.title.lower()).strip('-')
-
-        if len(self.slug.split()) > 0:
-            self.slug = re.sub('[^\w]+', '-', self.slug.lower()).strip('-')
-        else:
-            self.slug = pinyin.get(self.title)  # deal with chinese characters
-            self.slug = re.sub('[^\w]+', '-', self.slug.lower()).strip('-')
-
-        # deal with slug conflict
-        slug_suffix = 2
-        while True:
-            try:
-                self.get(Article.slug == self.slug)
-            except:
-                break
-            self.slug += "-%d" % slug_suffix
-            slug_suffix += 1
+        slug = make_slug(self.slug, self.title)
+
+        # deal with slug conflict, this article's own slug is no conflict
+        self.slug = free_slug(slug, Article.taken_slugs([slug], exclude=self.id))
+
+        old_content = None
+        if self.id is not None:
+            old_content = Article.select(Article.content).where(Article.id == self.id).scalar()
 
         ret = super(Article, self).save(*args, **kwargs)
+        if old_content is not None and old_content != self.content:
+            # the html of the old version would never be read again
+            RenderedMarkdown.forget(set(markdown_sources(old_content)) -
+                                    set(markdown_sources(self.content)))
+        self.prerender()
+        if index:
+            ArticleIndex.index(self)
         return ret
 
+    @classmethod
+    def taken_slugs(cls, slugs, exclude=None):
+        "The slugs in use that are one of slugs or one of them plus a suffix"
+        slugs = sorted(set(slugs))
+        taken = set()
+        # the ORs nest one level per slug and sqlite's parser stack overflows
+        # from about 84 of them, so twenty at a time
+        for i in range(0, len(slugs), 20):
+            # a range rather than LIKE 'slug-%', so the slug index is used
+            where = functools.reduce(operator.or_, [
+                (Article.slug == slug) |
+                ((Article.slug >= slug + '-') & (Article.slug < slug + '.'))
+                for slug in slugs[i:i + 20]])
+            if exclude is not None:
+                where &= (Article.id != exclude)
+            query = Article.select(Article.slug).where(where).tuples()
+            taken.update(slug for slug, in query)
+        return taken
+
+    @classmethod
+    def insert_batch(cls, rows):
+        """
+        Insert many articles with a single statement. Their slugs are made
+        unique, among themselves and against the database, in memory first.
+        Returns the rows with the slugs they got.
+        """
+        for row in rows:
+            row['slug'] = make_slug(row.get('slug'), row['title'])
+        taken = Article.taken_slugs([row['slug'] for row in rows])
+        for row in rows:
+            row['slug'] = free_slug(row['slug'], taken)
+            taken.add(row['slug'])
+
+        for i in range(0, len(rows), 100):
+            Article.insert_many(rows[i:i + 100]).execute()
+        return rows
+
     @classmethod
     def public(cls):
         return Article.select().where(Article.is_published == True)
@@ -141,6 +313,93 @@ class Article(BaseModel):
     def drafts(cls):
         return Article.select().where(Article.is_published == False)
 
+    @classmethod
+    def with_tags(cls, articles):
+        "Load the tags of all the given articles with one query"
+        articles = list(articles)
+        tags = dict((article.id, []) for article in articles)
+        if tags:
+            query = (Tag
+                     .select(Tag, ArticleTagThrough.article.alias('tagged_article'))
+                     .join(ArticleTagThrough)
+                     .where(ArticleTagThrough.article << list(tags.keys()))
+                     .naive())
+            for tag in query:
+                tags[tag.tagged_article].append(tag)
+
+        for article in articles:
+            article._prefetched_tags = tags[article.id]
+        return articles
+
+
+def markdown_sources(content):
+    "The markdown rendered for an article: its content and its abstract"
+    return [source for source in (content, abstract_markdown(content)) if source is not None]
+
+
+def abstract_markdown(content):
+    # is there a tag: <!-- more --> or <!--more--> ?
+    for tag in MORE_TAGS:
+        index = content.find(tag)
+        if index != -1:
+            return content[:index]
+    return None
+
+
+def slugify(text):
+    return re.sub('[^\w]+', '-', text.lower()).strip('-')
+
+
+def make_slug(slug, title):
+    "URL-friendly slug from the given one, or else from the title"
+    slug = slugify(slug or '') or slugify(title)
+    if not slug:
+        slug = slugify(pinyin.get(title))  # deal with chinese characters
+    return slug
+
+
+def free_slug(slug, taken):
+    "slug, or slug-2, slug-3... whichever isn't taken first"
+    candidate = slug
+    suffix = 2
+    while candidate in taken:
+        candidate = '%s-%d' % (slug, suffix)
+        suffix += 1
+    return candidate
+
+
+# The slugs of all articles in post_date order, one list for readers and one
+# for the author, so that detail pages find their neighbours without a query.
+# Changes made by other processes drop them through content_stamp.
+neighbour_cache = LRUCache(2, stamp=content_stamp)
+
+
+class ArticleOrder(object):
+
+    def __init__(self, rows):
+        self.slugs = [slug for id, slug in rows]
+        self.positions = dict((id, i) for i, (id, slug) in enumerate(rows))
+
+
+def article_order(public_only):
+    order = neighbour_cache.get(public_only)
+    if order is None:
+        query = Article.public() if public_only else Article.select()
+        rows = (query
+                .select(Article.id, Article.slug)
+                .order_by(Article.post_date.desc(), Article.id.desc())
+                .tuples())
+        order = ArticleOrder(list(rows))
+        neighbour_cache.set(public_only, order)
+    return order
+
+
+@invalidator
+def invalidate_neighbours(kind, article=None):
+    # publishing, unpublishing, deleting, and slug or date changes
+    if kind in ('article', 'category'):
+        neighbour_cache.clear()
+
 
 class Tag(BaseModel):
     name = CharField(unique=True)
@@ -157,8 +416,50 @@ class Tag(BaseModel):
 
     @property
     def article_count(self):
+        # set by with_counts(), otherwise count the articles of this tag
+        count = getattr(self, 'num_articles', None)
+        if count is not None:
+            return count
         return self.articles.count()
 
+    @classmethod
+    def resolve(cls, names):
+        """
+        The tags with the given names, matched regardless of case, creating
+        the ones that don't exist yet.
+        """
+        wanted = OrderedDict()
+        for name in names:
+            wanted.setdefault(name.lower(), name)
+        if not wanted:
+            return []
+
+        # lower(name) is backed by the tag_name_lower index; sqlite only
+        # lowercases ascii, so exact names are looked up as well
+        query = Tag.select().where((fn.Lower(Tag.name) << list(wanted.keys())) |
+                                   (Tag.name << list(wanted.values())))
+        found = dict((tag.name.lower(), tag) for tag in query)
+
+        missing = [name for key, name in wanted.items() if key not in found]
+        if missing:
+            Tag.insert_many([{'name': name} for name in missing]).execute()
+            for tag in Tag.select().where(Tag.name << missing):
+                found[tag.name.lower()] = tag
+
+        return [found[key] for key in wanted]
+
+    @classmethod
+    def with_counts(cls, public_only=False):
+        "All tags with the number of their articles, in a single query"
+        on = (ArticleTagThrough.article == Article.id)
+        if public_only:
+            on &= (Article.is_published == True)
+        return (Tag
+                .select(Tag, fn.COUNT(Article.id).alias('num_articles'))
+                .join(ArticleTagThrough, JOIN.LEFT_OUTER)
+                .join(Article, JOIN.LEFT_OUTER, on=on)
+                .group_by(Tag))
+
 
 class ArticleTagThrough(BaseModel):
     article = ForeignKeyField(Article)
@@ -175,10 +476,81 @@ class Comment(BaseModel):
     email = CharField()
     website = CharField(null=True)
     content = TextField()
-    post_date = DateTimeField(default=datetime.datetime.now())
+    post_date = DateTimeField(default=datetime.datetime.now)
     parent = ForeignKeyField('self', related_name='children', null=True)
     article = ForeignKeyField(Article, related_name='comments')
 
+    class Meta:
+        indexes = (
+            (('article', 'post_date'), False),
+        )
+
+    @classmethod
+    def threads(cls, article_id):
+        """
+        All comments of an article as threads. They are fetched again only
+        when the count or the latest id of the comments, read from the
+        (article, post_date) index, no longer match, so comments written by
+        other processes show up too.
+        """
+        version = (Comment
+                   .select(fn.COUNT(Comment.id), fn.MAX(Comment.id))
+                   .where(Comment.article == article_id)
+                   .tuples()
+                   .get())
+        cached = comment_cache.get(article_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        query = (Comment
+                 .select()
+                 .where(Comment.article == article_id)
+                 .order_by(Comment.post_date, Comment.id))
+        threads = CommentThreads(list(query))
+        comment_cache.set(article_id, (version, threads))
+        return threads
+
+
+class CommentThreads(object):
+    """
+    The comments of an article assembled into a tree: the top-level comments
+    in threads, oldest first, and the replies to every comment in replies.
+    """
+
+    def __init__(self, comments):
+        self.count = len(comments)
+        self.latest = max(comments, key=lambda comment: comment.id) if comments else None
+        self.threads = []
+
+        by_id = {}
+        for comment in comments:
+            comment.replies = []
+            by_id[comment.id] = comment
+        for comment in comments:
+            parent = by_id.get(comment.parent_id)
+            if parent is not None:
+                parent.replies.append(comment)
+            else:
+                self.threads.append(comment)
+
+    def page(self, page, per_page):
+        return self.threads[(page - 1) * per_page:page * per_page]
+
+    def page_count(self, per_page):
+        return max((len(self.threads) + per_page - 1) // per_page, 1)
+
+
+# (version, assembled comment threads) per article id
+comment_cache = LRUCache(app.config.get('COMMENT_CACHE_SIZE', 256))
+
+
+@invalidator
+def invalidate_comments(kind, article=None):
+    if kind in ('comment', 'article') and article is not None:
+        comment_cache.delete(article.id)
+    elif kind == 'category':
+        comment_cache.clear()
+
 
 class Profile(BaseModel):
     blog_title = CharField()
@@ -190,10 +562,195 @@ class Profile(BaseModel):
     @property
     def about_me_html(self):
         "Convert markdown content to html"
-        return markdown(self.about_me, ['markdown.extensions.extra'])
+        return render_markdown(self.about_me)
+
+
+class ArticleIndex(FTS5Model):
+    "Full-text index of articles, the rowid of a row is the article's id"
+    rowid = RowIDField()
+    title = SearchField()
+    content = SearchField()
+    tags = SearchField()
+
+    class Meta:
+        database = db
+        extension_options = {'tokenize': 'porter unicode61'}
+
+    @classmethod
+    def index(cls, article):
+        if not search_enabled():
+            return
+        cls.delete().where(cls.rowid == article.id).execute()
+        cls.insert(rowid=article.id, title=article.title, content=article.content,
+                   tags=' '.join(tag.name for tag in article.tags)).execute()
+
+    @classmethod
+    def unindex(cls, articles):
+        "Drop the rows of the articles selected by a query of their ids"
+        if search_enabled():
+            cls.delete().where(cls.rowid << articles).execute()
+
+    @classmethod
+    def rebuild(cls):
+        "Index every article from scratch"
+        tag_names = fn.GROUP_CONCAT(Tag.name, ' ')
+        query = (Article
+                 .select(Article.id, Article.title, Article.content, tag_names)
+                 .join(ArticleTagThrough, JOIN.LEFT_OUTER)
+                 .join(Tag, JOIN.LEFT_OUTER)
+                 .group_by(Article.id))
+        with db.atomic():
+            cls.delete().execute()
+            cls.insert_from([cls.rowid, cls.title, cls.content, cls.tags], query).execute()
+
+    @classmethod
+    def search(cls, phrase, public_only=True, page=1, paginate_by=10):
+        """
+        Articles matching all words of phrase, best match first, along with
+        the total number of matches. Every article gets a title_html and a
+        snippet of its content with the matched words highlighted.
+        """
+        # quote every word, so that nothing a reader types is taken for
+        # FTS5 query syntax
+        words = ['"%s"' % word.replace('"', '""') for word in phrase.split()]
+        if not words:
+            return [], 0
+
+        where = 'articleindex MATCH ?'
+        if public_only:
+            where += ' AND a.is_published = 1'
+        sql = ('FROM articleindex JOIN article AS a ON a.id = articleindex.rowid '
+               'WHERE ' + where)
+        params = [' '.join(words)]
+
+        total = db.execute_sql('SELECT COUNT(*) ' + sql, params).fetchone()[0]
+        # title weighs the most, then tags, then content
+        articles = Article.raw(
+            "SELECT a.*, highlight(articleindex, 0, ?, ?) AS title_html, "
+            "snippet(articleindex, 1, ?, ?, '...', 32) AS snippet " + sql +
+            ' ORDER BY bm25(articleindex, 10.0, 1.0, 5.0) LIMIT ? OFFSET ?',
+            *([HIGHLIGHT_START, HIGHLIGHT_END] * 2 + params +
+              [paginate_by, (page - 1) * paginate_by]))
+
+        articles = list(articles)
+        for article in articles:
+            article.title_html = highlighted(article.title_html)
+            article.snippet = highlighted(article.snippet)
+        return articles, total
+
+
+# search matches are marked with these by sqlite and turned into <mark> tags
+# only after the surrounding text has been escaped
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+
+def highlighted(text):
+    html = escape(text or '')
+    return Markup(html.replace(HIGHLIGHT_START, Markup('<mark>'))
+                      .replace(HIGHLIGHT_END, Markup('</mark>')))
+
+
+def search_enabled():
+    return app.config.get('SEARCH_ENABLED', False)
+
+
+class RenderedMarkdown(BaseModel):
+    key = CharField(primary_key=True)
+    html = TextField()
+
+    @classmethod
+    def forget(cls, sources):
+        """
+        Drop the html of markdown sources that were edited or deleted. An
+        article with the same source renders it again when it is next shown.
+        """
+        keys = sorted(set(markdown_key(source) for source in sources))
+        for i in range(0, len(keys), 100):
+            cls.delete().where(cls.key << keys[i:i + 100]).execute()
+        for key in keys:
+            markdown_cache.delete(key)
+
+    @classmethod
+    def prune(cls):
+        "Drop the html rendered by other versions of the renderer"
+        # keys start with the version, so this is a range of the primary key
+        low, high = RENDERER_VERSION + ':', RENDERER_VERSION + ';'
+        cls.delete().where((cls.key < low) | (cls.key >= high)).execute()
+
+
+def renderer_version():
+    "Hash of everything besides the source that changes the html"
+    options = [MARKDOWN_EXTENSIONS, MARKDOWN_EXTENSION_CONFIGS]
+    if app.config.get('SERVER_HIGHLIGHT'):
+        options.append(pygments.__version__)
+    return hashlib.sha1(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+RENDERER_VERSION = renderer_version()
+
+
+def markdown_key(text):
+    "Version of the renderer and hash of the markdown source"
+    return '%s:%s' % (RENDERER_VERSION, hashlib.sha1(text.encode('utf-8')).hexdigest())
+
+
+def markdown_to_html(text):
+    with timed('markdown'):
+        return markdown(text, extensions=MARKDOWN_EXTENSIONS,
+                        extension_configs=MARKDOWN_EXTENSION_CONFIGS)
+
+
+def render_markdown(text):
+    """
+    Convert markdown to html, rendering each distinct source only once.
+    Results live in the in-process LRU and are persisted in RenderedMarkdown
+    so that other workers and restarts don't render them again.
+    """
+    key = markdown_key(text)
+    html = markdown_cache.get(key)
+    if html is not None:
+        return html
+
+    try:
+        html = RenderedMarkdown.get(RenderedMarkdown.key == key).html
+    except RenderedMarkdown.DoesNotExist:
+        html = markdown_to_html(text)
+        try:
+            RenderedMarkdown.insert(key=key, html=html).upsert().execute()
+        except DatabaseError as e:
+            # only a cache, a locked database mustn't fail the page
+            logger.warning('could not store rendered markdown: %s', e)
+
+    markdown_cache.set(key, html)
+    return html
 
 
 def create_tables():
-    db.connect()
     db.create_tables(
-        [User, Article, Tag, Category, ArticleTagThrough, Comment, Profile], safe=True)
+        [User, Article, Tag, Category, ArticleTagThrough, Comment, Profile,
+         RenderedMarkdown], safe=True)
+
+    # create_tables() leaves existing tables alone, so indexes added since
+    # the first release are created here
+    db.execute_sql('CREATE INDEX IF NOT EXISTS article_post_date_id ON article (post_date, id)')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS tag_name_lower ON tag (lower(name))')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS comment_article_id_post_date '
+                   'ON comment (article_id, post_date)')
+
+    # after an upgrade of markdown or pygments the old html is never read again
+    RenderedMarkdown.prune()
+
+    # full-text search needs sqlite built with FTS5
+    if app.config.get('FULL_TEXT_SEARCH') and ArticleIndex.fts5_installed():
+        app.config.update(SEARCH_ENABLED=True)
+        if not ArticleIndex.table_exists():
+            # every worker runs this on import, so another one may be
+            # creating the table right now
+            try:
+                with db.atomic():
+                    ArticleIndex.create_table()
+                    ArticleIndex.rebuild()
+            except OperationalError:
+                if not ArticleIndex.table_exists():
+                    raise
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import base64
+import datetime
+from flask import request, abort
+from blog import app
+from models import Article
+from cache import LRUCache, invalidator, content_stamp
+
+CURSOR_DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# total counts per query, only used to show "page 3 / 10" in the links
+count_cache = LRUCache(256, stamp=content_stamp)
+
+
+@invalidator
+def invalidate_counts(kind, article=None):
+    if kind in ('article', 'category'):
+        count_cache.clear()
+
+
+def encode_cursor(article):
+    value = '%s|%d' % (article.post_date.strftime(CURSOR_DATE_FORMAT), article.id)
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        token = token.encode('ascii')
+        value = base64.urlsafe_b64decode(token + b'=' * (-len(token) % 4)).decode('utf-8')
+        post_date, id = value.split('|')
+        return datetime.datetime.strptime(post_date, CURSOR_DATE_FORMAT), int(id)
+    except (ValueError, TypeError, UnicodeError):
+        abort(404)
+
+
+class NumberedPages(object):
+    "Page links for results that were paginated by hand"
+    keyset = False
+
+    def __init__(self, page, page_count):
+        self.page = page
+        self.page_count = page_count
+
+    def get_page(self):
+        return self.page
+
+    def get_page_count(self):
+        return self.page_count
+
+
+class KeysetPaginatedQuery(object):
+    """
+    Pages through an article query newest first, like PaginatedQuery, but
+    seeks to a page with the (post_date, id) of the article the link came
+    from instead of an OFFSET, so every page costs the same however deep it
+    is. The links carry opaque ?after= / ?before= cursors.
+    """
+    keyset = True
+
+    def __init__(self, query, paginate_by, page_var='page'):
+        self.query = query
+        self.paginate_by = paginate_by
+        self.page_var = page_var
+        self._object_list = None
+        self._has_previous = self._has_next = False
+
+    def get_page(self):
+        try:
+            return max(int(request.args.get(self.page_var, 1)), 1)
+        except ValueError:
+            return 1
+
+    def get_page_count(self):
+        "Number of pages, computed once per change of content"
+        key = self.query.sql()
+        key = repr((key[0], tuple(key[1])))
+        count = count_cache.get(key)
+        if count is None:
+            count = self.query.count()
+            count_cache.set(key, count)
+        return max((count + self.paginate_by - 1) // self.paginate_by, 1)
+
+    def get_object_list(self):
+        if self._object_list is not None:
+            return self._object_list
+
+        after = request.args.get('after')
+        before = request.args.get('before')
+        query = self.query
+        if before:
+            post_date, id = decode_cursor(before)
+            query = query.where((Article.post_date > post_date) |
+                                ((Article.post_date == post_date) & (Article.id > id)))
+            query = query.order_by(Article.post_date.asc(), Article.id.asc())
+        else:
+            if after:
+                post_date, id = decode_cursor(after)
+                query = query.where((Article.post_date < post_date) |
+                                    ((Article.post_date == post_date) & (Article.id < id)))
+            query = query.order_by(Article.post_date.desc(), Article.id.desc())
+
+        # one extra row tells whether there is another page in that direction
+        object_list = list(query.limit(self.paginate_by + 1))
+        more = len(object_list) > self.paginate_by
+        object_list = object_list[:self.paginate_by]
+        if before:
+            object_list.reverse()
+            self._has_previous, self._has_next = more, True
+        else:
+            self._has_previous, self._has_next = bool(after), more
+
+        self._object_list = object_list
+        return object_list
+
+    def has_previous(self):
+        self.get_object_list()
+        return self._has_previous and bool(self._object_list)
+
+    def has_next(self):
+        self.get_object_list()
+        return self._has_next and bool(self._object_list)
+
+    def previous_args(self):
+        return {'before': encode_cursor(self.get_object_list()[0]),
+                self.page_var: self.get_page() - 1}
+
+    def next_args(self):
+        return {'after': encode_cursor(self.get_object_list()[-1]),
+                self.page_var: self.get_page() + 1}
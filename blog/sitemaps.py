@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+from xml.sax.saxutils import escape
+from peewee import fn
+from blog import app
+from models import Article
+from cache import invalidator
+from helper import external_url
+
+# Sitemaps for crawlers: /sitemap.xml is an index of /sitemap-<n>.xml chunks,
+# chunk n listing the public articles with n * SITEMAP_SIZE <= id < (n + 1) *
+# SITEMAP_SIZE, so that a change of one article only concerns its own chunk.
+# Generated files are kept in SITEMAP_CACHE_DIR, shared by all workers.
+
+SITEMAP_SIZE = app.config.get('SITEMAP_SIZE', 10000)
+CACHE_DIR = app.config.get('SITEMAP_CACHE_DIR', 'sitemap_cache')
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+NAMESPACE = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+def cache_path(name):
+    return os.path.join(CACHE_DIR, name)
+
+
+def w3c_date(dt):
+    return dt.strftime('%Y-%m-%d')
+
+
+def cached(name, generate):
+    """
+    Stream the cached file name, or the output of generate() while saving
+    it, so that the next request gets the file. Nothing is saved if the
+    client goes away halfway.
+    """
+    try:
+        f = open(cache_path(name), 'rb')
+    except IOError:
+        pass
+    else:
+        with f:
+            for block in iter(lambda: f.read(64 * 1024), b''):
+                yield block
+        return
+
+    try:
+        os.makedirs(CACHE_DIR)
+    except OSError:
+        pass  # exists already
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR)
+    complete = False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for piece in generate():
+                piece = piece.encode('utf-8')
+                f.write(piece)
+                yield piece
+        os.rename(tmp, cache_path(name))
+        complete = True
+    finally:
+        if not complete:
+            os.remove(tmp)
+
+
+def chunk_count():
+    last = Article.public().select(fn.MAX(Article.id)).scalar()
+    return (last // SITEMAP_SIZE + 1) if last is not None else 1
+
+
+def generate_index():
+    yield XML_HEADER
+    yield '<sitemapindex xmlns="%s">\n' % NAMESPACE
+    chunks = (Article
+              .public()
+              .select((Article.id / SITEMAP_SIZE).alias('chunk'), fn.MAX(Article.post_date))
+              .group_by(Article.id / SITEMAP_SIZE)
+              .order_by(Article.id / SITEMAP_SIZE)
+              .tuples())
+    lastmod = dict((chunk, post_date) for chunk, post_date in chunks)
+    # the first chunk also has the pages that aren't articles
+    lastmod.setdefault(0, None)
+    for n in sorted(lastmod):
+        yield '<sitemap><loc>%s</loc>' % escape(external_url('sitemap', n=n))
+        if lastmod[n] is not None:
+            yield '<lastmod>%s</lastmod>' % w3c_date(lastmod[n])
+        yield '</sitemap>\n'
+    yield '</sitemapindex>\n'
+
+
+def generate_chunk(n):
+    yield XML_HEADER
+    yield '<urlset xmlns="%s">\n' % NAMESPACE
+    if n == 0:
+        for endpoint in ('index', 'tags', 'about'):
+            yield '<url><loc>%s</loc></url>\n' % escape(external_url(endpoint))
+    articles = (Article
+                .public()
+                .select(Article.slug, Article.post_date)
+                .where((Article.id >= n * SITEMAP_SIZE) & (Article.id < (n + 1) * SITEMAP_SIZE))
+                .order_by(Article.id)
+                .tuples())
+    for slug, post_date in articles.iterator():
+        yield '<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (
+            escape(external_url('detail', slug=slug)), w3c_date(post_date))
+    yield '</urlset>\n'
+
+
+def sitemap_index():
+    return cached('sitemap.xml', generate_index)
+
+
+def sitemap_chunk(n):
+    "The chunk as a generator, None if there is no such chunk"
+    if not os.path.exists(cache_path('sitemap-%d.xml' % n)) and n >= chunk_count():
+        return None
+    return cached('sitemap-%d.xml' % n, lambda: generate_chunk(n))
+
+
+@invalidator
+def invalidate_sitemaps(kind, article=None):
+    if kind == 'article' and article is not None and article.id is not None:
+        for name in ('sitemap.xml', 'sitemap-%d.xml' % (article.id // SITEMAP_SIZE)):
+            try:
+                os.remove(cache_path(name))
+            except OSError:
+                pass
+    elif kind in ('article', 'category'):
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
@@ -2,17 +2,57 @@
 
 from blog import app, logger
 from models import *
-from flask import Flask, session, url_for, flash, redirect, render_template, request, abort
+from cache import page_cache, page_key, content_changed, make_version, not_modified, set_validators
+from flask import Flask, session, url_for, flash, redirect, render_template, request, abort, g, \
+    stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from playhouse.flask_utils import get_object_or_404, object_list
+from playhouse.flask_utils import get_object_or_404, object_list, PaginatedQuery
+import datetime
+import functools
+import time
 import urllib
-from peewee import fn
-from helper import random_string, load_settings
+from helper import random_string, save_settings, refresh_settings, comment_token_window, \
+    check_comment_token
+from pagination import KeysetPaginatedQuery, NumberedPages
+from feeds import get_feed
+from sitemaps import sitemap_index, sitemap_chunk
+from assets import send_asset
+from comment_queue import submit_comment
+from compress import compressible, negotiate, compress_body
+import metrics
+
+
+@app.after_request
+def add_validators(response):
+    return set_validators(response)
+
+
+@app.before_request
+def db_connect():
+    if db.is_closed():
+        db.connect()
+
+
+@app.teardown_request
+def db_close(exc):
+    # hands the connection back to the pool when DATABASE_POOL is on
+    if not db.is_closed():
+        db.close()
+
+
+@app.before_request
+def check_settings():
+    refresh_settings()
 
 
 @app.before_request
 def csrf_protect():
     if request.method == "POST":
+        if request.endpoint == 'comment':
+            # see comment_token()
+            if not check_comment_token(request.form.get('_csrf_token'), request.view_args['slug']):
+                abort(403)
+            return
         token = session.pop('_csrf_token', None)
         if not token or token != request.form.get('_csrf_token'):
             abort(403)
@@ -23,6 +63,15 @@ def timeformat(dt):
     return dt.strftime('%Y/%m/%d %H:%M')
 
 
+@app.template_filter()
+def atomtime(dt):
+    # dates are stored in local time, feeds want them in UTC
+    if dt is None:
+        dt = datetime.datetime.now()
+    utc = datetime.datetime.utcfromtimestamp(time.mktime(dt.timetuple()))
+    return utc.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
 @app.template_filter('clean_querystring')
 def clean_querystring(request_args, *keys_to_remove, **new_values):
     # This is from peewee example #
@@ -35,7 +84,90 @@ def clean_querystring(request_args, *keys_to_remove, **new_values):
     for key in keys_to_remove:
         querystring.pop(key, None)
     querystring.update(new_values)
-    return urllib.urlencode(querystring)
+    # sorted, so that a page always gets the same URL (page cache, export)
+    return urllib.urlencode(sorted(querystring.items()))
+
+
+def cached_page(view):
+    """
+    Serve anonymous GET requests of view from page_cache. Pages are shared by
+    all readers, so views using it must not render anything of the session,
+    like csrf_token(); comment forms carry comment_token() instead.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if (page_cache is None or not app.config.get('PAGE_CACHE') or request.method != 'GET' or
+                current_user.is_authenticated or '_flashes' in session):
+            return view(*args, **kwargs)
+
+        # comment forms get a new token every window, and so a new entry
+        window = ('#%d' % comment_token_window()).encode('ascii')
+        key = page_key(request.endpoint, request.view_args, request.query_string + window)
+        entry = page_cache.get(key)
+        if entry is not None:
+            body, content_type, validators = entry[:3]
+            if validators is not None:
+                response = not_modified(validators)
+                if response is not None:
+                    return response
+            variants = entry[3] if len(entry) > 3 else {}
+            return compressed_page(key, body, content_type, validators, variants)
+
+        response = app.make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.direct_passthrough:
+            page_cache.set(key, (response.get_data(), response.headers.get('Content-Type'),
+                                 g.get('page_validators'), {}))
+        return response
+    return wrapper
+
+
+def compressed_page(key, body, content_type, validators, variants):
+    """
+    Answer with a cached page that is the same for every reader. It is
+    compressed once per encoding, and the result is kept with the page.
+    """
+    response = app.response_class(body, content_type=content_type)
+    if (not app.config.get('COMPRESS') or not compressible(content_type) or
+            len(body) < app.config.get('COMPRESS_MIN_SIZE', 500)):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    if encoding not in variants:
+        variants = dict(variants)
+        variants[encoding] = compress_body(body, encoding, best=True)
+        page_cache.set(key, (body, content_type, validators, variants))
+    response.set_data(variants[encoding])
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def paginate(query, paginate_by):
+    if app.config.get('PAGINATION') == 'keyset':
+        return KeysetPaginatedQuery(query, paginate_by)
+    return PaginatedQuery(query, paginate_by, check_bounds=True)
+
+
+def article_list(template, query, paginate_by, with_category=False, **context):
+    # Same as object_list, but the tags of the whole page are fetched with a
+    # single query instead of one query per article. with_category for pages
+    # showing the category names, which renames change.
+    pagination = paginate(query, paginate_by)
+    object_list = Article.with_tags(pagination.get_object_list())
+
+    # the page only changes when one of its articles or its links do
+    links = [pagination.get_page(), pagination.get_page_count()]
+    if getattr(pagination, 'keyset', False):
+        links += [pagination.has_previous(), pagination.has_next()]
+    version = make_version(template, context, links,
+                           [article.fingerprint(with_category) for article in object_list])
+    response = not_modified(version)
+    if response is not None:
+        return response
+
+    return render_template(template, pagination=pagination, object_list=object_list, **context)
 
 
 # flask-login
@@ -46,7 +178,7 @@ login_manager.init_app(app)
 @login_manager.user_loader
 def load_user(id):
     try:
-        ret = User.get(User.id == int(id))
+        ret = User.cached(int(id))
     except:
         ret = None
     return ret
@@ -102,6 +234,7 @@ def logout():
 
 @app.route('/', methods=['GET'])
 @app.route('/index', methods=['GET'])
+@cached_page
 def index():
     if app.config.get('INSTALL', False):
         return redirect(url_for('install'))
@@ -111,44 +244,70 @@ def index():
     else:
         query = Article.public().order_by(Article.post_date.desc())
 
-    if query.count() == 0:
+    if not query.exists():
         flash('There is no any article at all, create one please')
         return redirect(url_for('create'))
 
     # pagination
-    return object_list('index.html', query, paginate_by=app.config.get('PER_PAGE'))
+    return article_list('index.html', query, paginate_by=app.config.get('PER_PAGE'))
 
 
 @app.route('/blog/<slug>/')
+@cached_page
 def detail(slug):
     if current_user.is_authenticated:
         query = Article.select()
     else:
         query = Article.public()
     article = get_object_or_404(query, Article.slug == slug)
-    comments = article.comments
+    Article.with_tags([article])
 
-    qp = query.where(Article.id > article.id).order_by(
-        Article.id.asc()).limit(1)
-    qn = query.where(Article.id < article.id).order_by(
-        Article.id.desc()).limit(1)
+    prev_slug, next_slug = article.neighbours(public_only=not current_user.is_authenticated)
 
+    # comments are paginated by thread
+    comments = Comment.threads(article.id)
+    per_page = app.config.get('COMMENTS_PER_PAGE', 50)
     try:
-        prev_slug = qp[0].slug
-    except:
-        prev_slug = None
+        comment_page = max(int(request.args.get('cpage', 1)), 1)
+    except ValueError:
+        comment_page = 1
+    reply_to = request.args.get('reply_to', type=int)
+
+    version = make_version(article.fingerprint(), comments.latest and comments.latest.id,
+                           prev_slug, next_slug, comment_page, reply_to, comment_token_window())
+    response = not_modified(version)
+    if response is not None:
+        return response
+
+    return render_template('detail.html', entry=article, comments=comments.page(comment_page, per_page),
+                           comment_count=comments.count, comment_page=comment_page,
+                           comment_page_count=comments.page_count(per_page), reply_to=reply_to,
+                           prev_slug=prev_slug, next_slug=next_slug)
 
+
+@app.route('/search/')
+def search():
+    if not app.config.get('SEARCH_ENABLED'):
+        abort(404)
+
+    q = request.args.get('q', '').strip()
     try:
-        next_slug = qn[0].slug
-    except:
-        next_slug = None
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    paginate_by = app.config.get('PER_PAGE', 10)
 
-    return render_template('detail.html', entry=article, comments=comments, prev_slug=prev_slug, next_slug=next_slug)
+    results, total = ArticleIndex.search(q, public_only=not current_user.is_authenticated,
+                                         page=page, paginate_by=paginate_by)
+    pagination = NumberedPages(page, (total + paginate_by - 1) // paginate_by)
+    return render_template('search.html', q=q, results=results, total=total, pagination=pagination)
 
 
 @app.route('/tags/')
+@cached_page
 def tags():
-    tags = Tag.select()
+    # anonymous readers only get to count the published articles
+    tags = Tag.with_counts(public_only=not current_user.is_authenticated)
     return render_template('tags.html', tags=tags)
 
 
@@ -179,57 +338,31 @@ def create():
         author = current_user.id
         category = category_id
 
-        tags = []
-        if tag_names:
-            tag_names = tag_names.strip().split(' ')
-            for name in tag_names:
-                try:
-                    tag = Tag.select().where(
-                        fn.Lower(Tag.name) == name.lower())[0]
-                except IndexError:
-                    tag = Tag.create(name=name)
-                #ArticleTagThrough.create(article=article, tag=tag)
-                tags.append(tag)
-
-        if id:  # update
-            query = Article.update(title=title, category=category, content=content, author=author,
-                                   is_published=is_published, slug=slug).where(Article.id == id)
-            query.execute()
-            article = Article.get(Article.id == id)
-        else:   # create
-            article = Article.create(title=title, category=category, content=content, author=author,
-                                     is_published=is_published, slug=slug)
-
-        # get previous tags
-        previous_tags = []
-        query = ArticleTagThrough.select().where(
-            ArticleTagThrough.article == article.id)
-        for article_tag in query:
-            previous_tags.append(article_tag.id)
-
-        # update tags
-        current_tags = []
-        for tag in tags:
-            try:
-                q = ArticleTagThrough.get(ArticleTagThrough.article == article.id,
-                                          ArticleTagThrough.tag == tag.id)
-            except:
-                # create new tag
-                q = ArticleTagThrough.create(article=article, tag=tag)
-            current_tags.append(q.id)
-
-        # delete unused tags
-        for tag_id in current_tags:
-            try:
-                previous_tags.remove(tag_id)
-            except ValueError:
-                pass  # do nothing
-
-        for tag_id in previous_tags:
-            qurey = ArticleTagThrough.delete().where(
-                ArticleTagThrough.id == tag_id)
-            qurey.execute()
-
+        # the article and its tags are saved together, or not at all
+        with db.atomic():
+            tags = Tag.resolve((tag_names or '').split())
+
+            if id:  # update
+                # through save(), so the slug is cleaned up and kept unique
+                article = Article.get(Article.id == id)
+                article.title = title
+                article.category = category
+                article.content = content
+                article.author = author
+                article.is_published = is_published
+                article.slug = slug
+                article.save(index=False)
+            else:   # create
+                article = Article(title=title, category=category, content=content, author=author,
+                                  is_published=is_published, slug=slug)
+                article.save(index=False)
+
+            article.set_tags(tags)
+
+            # index the article once its tags are known
+            ArticleIndex.index(article)
+
+        content_changed('article', article)
         flash('Article created/updated successfully.', 'success')
 
         if article.is_published:
@@ -261,15 +394,16 @@ def drafts():
     title = "Drafts"
     query = Article.drafts().order_by(Article.post_date.desc())
 
-    if query.count() == 0:
+    if not query.exists():
         flash('There is no drafts yet, please create one')
         return redirect(url_for('create'))
 
     # pagination
-    return object_list('lists.html', query, paginate_by=app.config.get('PER_PAGE', 10), title=title)
+    return article_list('lists.html', query, paginate_by=app.config.get('PER_PAGE', 10), title=title)
 
 
 @app.route('/lists/')
+@cached_page
 def lists():
     tag = request.args.get('tag')
     cat = request.args.get('cat')
@@ -285,7 +419,7 @@ def lists():
         title = "By category: %s" % cat
         query = Category.get(Category.name == cat).articles
 
-    return object_list('lists.html', query, paginate_by=app.config.get('PER_PAGE', 10), title=title)
+    return article_list('lists.html', query, paginate_by=app.config.get('PER_PAGE', 10), title=title)
 
 
 @app.route('/comment/<slug>', methods=['POST'])
@@ -294,11 +428,22 @@ def comment(slug):
     email = request.form.get('email', None)
     website = request.form.get('website', None)
     content = request.form.get('content', None)
-    article = Article.get(Article.slug == slug)
+    parent = request.form.get('parent', None, type=int)
+    article = get_object_or_404(Article.select(Article.id, Article.slug), Article.slug == slug)
+
+    # replies only to comments on the same article
+    if parent is not None and not Comment.select().where(
+            (Comment.id == parent) & (Comment.article == article.id)).exists():
+        parent = None
 
     if nickname and email and content:
-        Comment.create(nickname=nickname, email=email,
-                       website=website, content=content, article=article.id)
+        # written in the background, together with other new comments
+        accepted, message = submit_comment({'nickname': nickname, 'email': email, 'website': website,
+                                            'content': content, 'article': article.id, 'parent': parent,
+                                            'post_date': datetime.datetime.now()},
+                                           article, request.remote_addr)
+        if message:
+            flash(message)
     else:
         flash("Nickname, email and content can't be empty!")
 
@@ -308,34 +453,81 @@ def comment(slug):
 @login_required
 @app.route('/admin/')
 def admin():
-    qurey = Article.select()
-    if qurey.count() == 0:
+    # admin.html shows the category of every row, so join it in up front
+    qurey = Article.select(Article, Category).join(Category)
+    if not qurey.exists():
         flash('There is no any article at all, create one please')
         return redirect(url_for('create'))
-    return object_list('admin.html', qurey, paginate_by=10)
+    return article_list('admin.html', qurey, paginate_by=10, with_category=True)
 
 
 @login_required
 @app.route('/delete/<id>')
 def delete(id):
+    article = get_object_or_404(Article, Article.id == id)
+
     qurey = Article.delete().where(Article.id == id)
     qurey.execute()
 
     query = ArticleTagThrough.delete().where(ArticleTagThrough.article == id)
-    qurey.execute()
+    query.execute()
 
+    ArticleIndex.unindex([article.id])
+    RenderedMarkdown.forget(markdown_sources(article.content))
+    content_changed('article', article)
     return redirect(url_for('admin'))
 
 
 @app.route('/about/')
+@cached_page
 def about():
     return render_template('about.html')
 
 
+@app.route('/feed.xml')
+@app.route('/tags/<tag>/feed.xml')
+def feed(tag=None):
+    atom = get_feed(tag)
+    if atom is None:
+        abort(404)
+    response = app.response_class(atom.body, mimetype='application/atom+xml')
+    # the same for every reader, so shared caches may keep it too
+    # no Last-Modified: post dates don't change when articles are edited
+    response.set_etag(atom.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('FEED_CACHE_TTL', 60)
+    return response.make_conditional(request)
+
+
+@app.route('/sitemap.xml')
+def sitemap_xml():
+    return app.response_class(stream_with_context(sitemap_index()), mimetype='application/xml')
+
+
+@app.route('/sitemap-<int:n>.xml')
+def sitemap(n):
+    chunk = sitemap_chunk(n)
+    if chunk is None:
+        abort(404)
+    return app.response_class(stream_with_context(chunk), mimetype='application/xml')
+
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    return send_asset(filename)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled():
+        abort(404)
+    return app.response_class(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 @login_required
 @app.route('/category/')
 def category():
-    query = Category.select()
+    query = Category.with_counts()
     return object_list('category.html', query, paginate_by=app.config.get('PER_PAGE', 10), entry=None)
 
 
@@ -351,6 +543,7 @@ def category_add():
                 flash('Error! The category name is existed already')
             except:
                 Category.create(name=name)
+                content_changed('category')
                 flash('Successfully create category: %s' % name)
         return redirect(url_for('category'))
 
@@ -365,7 +558,7 @@ def category_edit(id):
         entry = None
         flash('Error! The category name: %s is not existed' % name)
 
-    query = Category.select()
+    query = Category.with_counts()
     return object_list('category.html', query, paginate_by=app.config.get('PER_PAGE', 10), entry=entry)
 
 
@@ -388,6 +581,7 @@ def category_add_or_edit():
                 else:  # add
                     Category.create(name=name)
                     flash('Successfully create category: %s' % name)
+                content_changed('category')
 
         return redirect(url_for('category'))
 
@@ -396,12 +590,17 @@ def category_add_or_edit():
 @app.route('/category/del/<int:id>')
 def category_delete(id):
     # delete the articles which in this category
+    ArticleIndex.unindex(Article.select(Article.id).where(Article.category == id))
+    RenderedMarkdown.forget(source for content, in Article.select(Article.content)
+                            .where(Article.category == id).tuples()
+                            for source in markdown_sources(content))
     query = Article.delete().where(Article.category == id)
     query.execute()
     # delete the cateogry
     qurey = Category.delete().where(Category.id == id)
     qurey.execute()
 
+    content_changed('category')
     return redirect(url_for('category'))
 
 
@@ -418,6 +617,9 @@ def settings():
         id = request.form.get('id')
 
         if id:  # update
+            old_about_me = Profile.select(Profile.about_me).where(Profile.id == id).scalar()
+            if old_about_me is not None and old_about_me != about_me:
+                RenderedMarkdown.forget([old_about_me])
             query = Profile.update(blog_title=blog_title, blog_nickname=blog_nickname,
                                    blog_description=blog_description, about_me=about_me, per_page=per_page)
             query.execute()
@@ -427,7 +629,7 @@ def settings():
             entry = Profile.create(blog_title=blog_title, blog_nickname=blog_nickname,
                                    blog_description=blog_description, about_me=about_me, per_page=per_page)
 
-        load_settings()
+        save_settings()
         flash('Successfully save the settings')
     else:
         try:
@@ -472,7 +674,7 @@ def install():
             pass
 
         app.config.update(INSTALL=False)
-        load_settings()
+        save_settings()
         return redirect(url_for('login'))
 
     if app.config.get('INSTALL') == False:
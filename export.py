@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+Render the public part of the blog into static files that nginx can serve:
+
+    python export.py /var/www/blog             # everything
+    python export.py /var/www/blog --changed   # only what changed since last time
+
+A page for /some/path/?args is written to some/path/index-args.html, and to
+some/path/index.html when it has no query string, so nginx can serve the
+export with:
+
+    location / {
+        try_files $uri/index-$args.html $uri/index.html $uri =404;
+    }
+    location /assets/ {
+        gzip_static on;
+        add_header Cache-Control "public, max-age=31536000, immutable";
+    }
+
+Comments, search and the admin pages still need the application, and the
+comment forms of exported pages only work until their token expires,
+COMMENT_TOKEN_WINDOW to twice that after the export.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import urllib
+
+from blog import app
+from blog.assets import copy_assets
+from blog.models import db, Article, Tag, ArticleTagThrough, Profile
+from flask import url_for
+from peewee import fn, JOIN
+
+STATE_FILE = '.export-state.json'
+
+_client = None
+
+
+def page_url(endpoint, **args):
+    "URL of a page, with its query string in the order the templates use"
+    # arguments of the URL rule go into the path, the others into the query string
+    rule_args = set()
+    for rule in app.url_map.iter_rules(endpoint):
+        rule_args.update(rule.arguments)
+    path_args = dict((key, value) for key, value in args.items() if key in rule_args)
+    query_args = [(key, value) for key, value in args.items() if key not in rule_args]
+    if endpoint == 'index':
+        # url_for builds /index, but the home page and the ./?page=N links
+        # of its listing are at the root
+        path = '/'
+    else:
+        with app.test_request_context():
+            path = url_for(endpoint, **path_args)
+    if query_args:
+        path += '?' + urllib.urlencode(sorted(
+            (key, value.encode('utf-8') if hasattr(value, 'encode') else value)
+            for key, value in query_args))
+    return path
+
+
+def page_filename(output, url):
+    path, _, query_string = url.partition('?')
+    path = urllib.unquote(path).strip('/')
+    name = 'index-%s.html' % query_string if query_string else 'index.html'
+    return os.path.join(output, path, name)
+
+
+def init_worker(output):
+    global _client
+    _client = (app.test_client(), output)
+
+
+def render(url):
+    client, output = _client
+    response = client.get(url)
+    if response.status_code != 200:
+        return url, response.status_code
+
+    filename = page_filename(output, url)
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # made by another worker meanwhile
+    with open(filename, 'wb') as f:
+        f.write(response.get_data())
+    return url, response.status_code
+
+
+def snapshot():
+    "What the public pages are made of, as stored in the export state"
+    tag_names = fn.GROUP_CONCAT(Tag.name, ' ').alias('tag_names')
+    query = (Article
+             .select(Article.id, Article.slug, Article.title, Article.content,
+                     Article.post_date, tag_names)
+             .join(ArticleTagThrough, JOIN.LEFT_OUTER)
+             .join(Tag, JOIN.LEFT_OUTER)
+             .where(Article.is_published == True)
+             .group_by(Article.id)
+             .order_by(Article.post_date.desc(), Article.id.desc())
+             .naive())
+
+    articles = []
+    for article in query.iterator():
+        tags = sorted((article.tag_names or '').split())
+        digest = hashlib.sha1(repr((article.slug, article.title, article.post_date, tags))
+                              .encode('utf-8'))
+        digest.update(article.content.encode('utf-8'))
+        articles.append({'id': article.id, 'slug': article.slug, 'tags': tags,
+                         'hash': digest.hexdigest()})
+
+    try:
+        profile = Profile.select()[0]
+        settings = [profile.blog_title, profile.blog_nickname, profile.blog_description,
+                    profile.about_me, profile.per_page]
+    except IndexError:
+        settings = None
+
+    return {'articles': articles, 'settings': settings,
+            'per_page': app.config.get('PER_PAGE', 10)}
+
+
+def listing_pages(endpoint, count, per_page, **args):
+    "Every page of a listing, page 1 under both of its URLs"
+    pages = [page_url(endpoint, **args), page_url(endpoint, page=1, **args)]
+    page_count = max((count + per_page - 1) // per_page, 1)
+    pages += [page_url(endpoint, page=page, **args) for page in range(2, page_count + 1)]
+    return pages
+
+
+def plan(state, previous):
+    """
+    URLs to render and files to delete to go from the previous export to the
+    current state. Without a previous export everything is rendered.
+    """
+    articles = state['articles']
+    per_page = state['per_page']
+    tag_counts = {}
+    for article in articles:
+        for tag in article['tags']:
+            tag_counts[tag] = tag_counts.get(tag, 0) + 1
+
+    full = (previous is None or previous['settings'] != state['settings'] or
+            previous['per_page'] != per_page)
+    old_articles = [] if previous is None else previous['articles']
+    old = dict((article['id'], article) for article in old_articles)
+    new = dict((article['id'], article) for article in articles)
+
+    changed = set(id for id in new if full or id not in old or old[id]['hash'] != new[id]['hash'])
+    removed = set(id for id in old if id not in new)
+    if not changed and not removed:
+        return [], []
+
+    # prev/next links of the neighbours, in the old and in the new order
+    neighbours = set()
+    for order in (old_articles, articles):
+        ids = [article['id'] for article in order]
+        for i, id in enumerate(ids):
+            if id in changed or id in removed:
+                neighbours.update(ids[max(i - 1, 0):i + 2])
+    detail_ids = (changed | neighbours) & set(new)
+
+    tags = set(tag_counts) if full else set()
+    for id in changed | removed:
+        for article in (old.get(id), new.get(id)):
+            if article is not None:
+                tags.update(article['tags'])
+
+    urls = [page_url('detail', slug=new[id]['slug']) for id in detail_ids]
+    urls += listing_pages('index', len(articles), per_page)
+    urls += [page_url('tags'), page_url('about')]
+    for tag in tags:
+        if tag in tag_counts:
+            urls += listing_pages('lists', tag_counts[tag], per_page, tag=tag)
+
+    # pages that are gone: removed articles, old slugs and empty listings
+    stale = [page_url('detail', slug=old[id]['slug']) for id in old
+             if id in removed or old[id]['slug'] != new[id]['slug']]
+    if previous is not None:
+        old_tag_counts = {}
+        for article in old_articles:
+            for tag in article['tags']:
+                old_tag_counts[tag] = old_tag_counts.get(tag, 0) + 1
+        for tag, count in old_tag_counts.items():
+            if tag not in tags:
+                continue  # untouched, its pages are still current
+            stale += [url for url in listing_pages('lists', count, previous['per_page'], tag=tag)
+                      if url not in urls]
+        stale += [url for url in listing_pages('index', len(old_articles), previous['per_page'])
+                  if url not in urls]
+    return urls, stale
+
+
+def copy_static(output):
+    source = os.path.join(app.root_path, 'static')
+    for root, dirs, files in os.walk(source):
+        target = os.path.join(output, 'static', os.path.relpath(root, source))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            shutil.copy2(os.path.join(root, name), os.path.join(target, name))
+    # pages link the fingerprinted copies, whose .gz nginx serves with gzip_static
+    copy_assets(os.path.join(output, 'assets'))
+
+
+def export(output, changed_only=False, jobs=None):
+    # render through the views exactly as a reader sees the blog, with page
+    # numbers that can be written out up front
+    app.config.update(PAGE_CACHE=None, PAGINATION='offset')
+
+    state_file = os.path.join(output, STATE_FILE)
+    previous = None
+    if changed_only and os.path.exists(state_file):
+        with open(state_file) as f:
+            previous = json.load(f)
+
+    state = snapshot()
+    urls, stale = plan(state, previous)
+    db.close()  # the workers open their own connections
+
+    for url in stale:
+        filename = page_filename(output, url)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    copy_static(output)
+    pool = multiprocessing.Pool(jobs, initializer=init_worker, initargs=(output,))
+    try:
+        for url, status in pool.imap_unordered(render, urls, chunksize=16):
+            if status != 200:
+                print('%s: HTTP %d' % (url, status))
+    finally:
+        pool.close()
+        pool.join()
+
+    with open(state_file, 'w') as f:
+        json.dump(state, f)
+    return len(urls), len(stale)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the blog as static files.')
+    parser.add_argument('output', help='directory to write the pages to')
+    parser.add_argument('--changed', action='store_true',
+                        help='only render pages affected by articles changed since the last export')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='number of rendering processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    rendered, removed = export(args.output, changed_only=args.changed, jobs=args.jobs)
+    print('%d pages rendered, %d removed' % (rendered, removed))
+
+
+if __name__ == '__main__':
+    main()
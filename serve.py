@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Serve the blog in production with gunicorn, using ProductionConfig unless
+BLOG_CONFIG says otherwise:
+
+    SECRET_KEY=... SITE_URL=https://blog.example.com python serve.py --workers 4 --threads 8
+
+Every worker process runs a pool of threads (gthread), so a slow client or
+a comment being written only holds up one thread, while idle keep-alive
+connections are parked in the worker's event loop. With --worker-class
+gevent the workers run greenlets instead, for many slow connections.
+On SIGTERM workers finish the requests they have for --graceful-timeout
+seconds before they are stopped.
+
+run.py is still there for development.
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+
+class BlogServer(BaseApplication):
+
+    def __init__(self, options):
+        self.options = options
+        super(BlogServer, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from blog import app
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the blog with gunicorn.')
+    parser.add_argument('--bind', default='127.0.0.1:8000')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count() * 2 + 1)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads per worker (gthread)')
+    parser.add_argument('--worker-class', default='gthread', choices=('gthread', 'gevent', 'sync'))
+    parser.add_argument('--worker-connections', type=int, default=1000,
+                        help='concurrent connections per worker (gevent)')
+    parser.add_argument('--keep-alive', type=int, default=5,
+                        help='seconds to keep idle connections open')
+    parser.add_argument('--timeout', type=int, default=30,
+                        help='seconds before a stuck worker is restarted')
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help='seconds workers get to finish their requests on shutdown')
+    args = parser.parse_args()
+
+    os.environ.setdefault('BLOG_CONFIG', 'blog.config.ProductionConfig')
+    if os.environ['BLOG_CONFIG'].endswith('ProductionConfig'):
+        for name in ('SECRET_KEY', 'SITE_URL'):
+            if not os.environ.get(name):
+                sys.exit('%s must be set in the environment' % name)
+
+    BlogServer({
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': args.worker_class,
+        'worker_connections': args.worker_connections,
+        'keepalive': args.keep_alive,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()